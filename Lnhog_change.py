@@ -5,21 +5,58 @@ import re
 import sys
 import time
 import os
+import io
 import json
 import collections
-from typing import List, Any
-import openpyxl
+import contextlib
+import threading
+import queue
+import functools
+import gzip
+import csv
+import bisect
+import random
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any, NamedTuple
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 import enetsdk as Enet
-from enetsdk.Framework.cm_handler import EMSHandler
 from enetconfig.config import ConfigManager
-from enetsdk.Utility import ExcelWrapper
-from tiermap.tier_mapper import TierMapper
-from tiermap import exceptions
 import enetsdk
 
+# openpyxl, ExcelWrapper, EMSHandler and sqlite3 are imported where they are used:
+# the framework imports the module for GetParameters, GetDesc, GetVersion and GetScopeRules,
+# which need none of them
+
 EMAIL_SUBJECT = "Eden-NET SON - "
 EMAIL_SUBJECT_ALARM = "Alarm_changes "
 
+# template row with additional bands: {"LTE_700": [9210, 9659], ...}
+TEMPLATE_BANDS_PARAM = "band_earfcn_ranges"
+
+# (first earfcn, last earfcn, band)
+BAND_EARFCN_RANGES = [
+    (9870, 9919, "LTE_450"),
+    (6150, 6449, "LTE_800"),
+    (1200, 1949, "LTE_1800"),
+    (2750, 3449, "LTE_2600"),
+    (0, 599, "LTE_2100"),
+    (38650, 39649, "LTE_2300"),
+    (38250, 38649, "LTE_1900"),
+    (46709, 54539, "LTE_Unlicensed"),
+]
+
+CARRIER_ATTRIBUTES = {"LNCEL_FDD": ["earfcnDL", "dlChBw"],
+                      "LNCEL_TDD": ["earfcn", "chBw"]}
+
+LNHOG_ATTRIBUTES = ["arfcnValueListGERAN", "bandIndicatorGERAN", "reportIntervalGERAN",
+                    "nccperm", "hysB2ThresholdGERAN", "b2Threshold2RssiGERAN",
+                    "b2TimeToTriggerGERANMeas",
+                    "b2Threshold1GERANQci1", "b2Threshold1GERAN", "b2Threshold2RssiGERANQci1"]
+
 USER_PARAMETERS = [
     (
         "Email Addresses (Optional)",
@@ -41,6 +78,13 @@ USER_PARAMETERS = [
         Enet.ENET_PARAM_TYPE_STRING_SET,
         "Unlocked cell only",
         ["All cells", "Unlocked cell only"]
+    ),
+    (
+        "Apply plan file",
+        "Plan file saved by an earlier run (plan_export in ini). If set, the saved plan is pushed instead of planning the network again.",
+        Enet.ENET_PARAM_TYPE_STRING,
+        "",
+        None
     )
 ]
 
@@ -58,6 +102,10 @@ class Report_Config(ConfigManager):
     def audit_type(self):
         return self.module_parameters.get("Audit Type", "")
 
+    @property
+    def apply_plan_file(self):
+        return self.module_parameters.get("Apply plan file", "")
+
     @property
     def excluded_type(self):
         return self.module_parameters.get("Excluded Type", "")
@@ -81,16 +129,205 @@ class MyModuleConfig(ConfigManager):
     def amount_in_request(self):
         return self.get_int("amount_in_request", default=300)
 
+    @property
+    def read_workers(self):
+        return self.get_int("read_workers", default=4)
+
+    @property
+    def topology_workers(self):
+        return self.get_int("topology_workers", default=4)
+
+    @property
+    def bcch_cache_file(self):
+        return self.get_str("bcch_cache_file", default="")
+
+    @property
+    def bcch_cache_ttl_hours(self):
+        return self.get_int("bcch_cache_ttl_hours", default=24)
+
+    @property
+    def push_batch_size(self):
+        return self.get_int("push_batch_size", default=100)
+
+    @property
+    def push_workers(self):
+        return self.get_int("push_workers", default=2)
+
+    @property
+    def push_retries(self):
+        return self.get_int("push_retries", default=1)
+
+    @property
+    def verify_mode(self):
+        return self.get_str("verify_mode", default="all")
+
+    @property
+    def verify_sample_size(self):
+        return self.get_int("verify_sample_size", default=100)
+
+    @property
+    def report_format(self):
+        return self.get_str("report_format", default="xlsx")
+
+    @property
+    def template_cache_file(self):
+        return self.get_str("template_cache_file", default="")
+
+    @property
+    def verbose(self):
+        return self.get_bool("verbose", default=False)
+
+    @property
+    def incremental_mode(self):
+        return self.get_bool("incremental_mode", default=False)
+
+    @property
+    def snapshot_file(self):
+        return self.get_str("snapshot_file", default="")
+
+    @property
+    def snapshot_ttl_hours(self):
+        return self.get_int("snapshot_ttl_hours", default=24)
+
+    @property
+    def plan_export(self):
+        return self.get_bool("plan_export", default=False)
+
+    @property
+    def plan_max_age_hours(self):
+        return self.get_int("plan_max_age_hours", default=24)
+
+    @property
+    def pipeline_mode(self):
+        return self.get_bool("pipeline_mode", default=False)
+
+    @property
+    def pipeline_chunk_cells(self):
+        return self.get_int("pipeline_chunk_cells", default=1000)
+
+    @property
+    def pipeline_queue_size(self):
+        return self.get_int("pipeline_queue_size", default=2)
+
+    @property
+    def memory_limit_mb(self):
+        return self.get_int("memory_limit_mb", default=0)
+
+    @property
+    def failure_backoff(self):
+        return self.get_bool("failure_backoff", default=False)
+
+    @property
+    def backoff_file(self):
+        return self.get_str("backoff_file", default="")
+
+    @property
+    def backoff_after_failures(self):
+        return self.get_int("backoff_after_failures", default=2)
+
+    @property
+    def backoff_base_hours(self):
+        return self.get_int("backoff_base_hours", default=6)
+
+    @property
+    def backoff_max_hours(self):
+        return self.get_int("backoff_max_hours", default=168)
+
+    @property
+    def push_mode(self):
+        return self.get_str("push_mode", default="strict").lower()
+
+    @property
+    def push_priority(self):
+        return [kind.strip().lower() for kind in
+                self.get_str("push_priority", default=",".join(ChangeBudget.KINDS)).split(",") if kind.strip()]
 
     @property
     def check_sw(self):
-        return self.get_str("check_sw", default="Yes")
+        return str(self.get_str("check_sw", default="Yes")).strip().lower() in ("yes", "true", "1")
 
     @property
     def sw_version(self):
-        return self.get_str("sw_version", default=["SBTS19A"])
+        value = self.get_str("sw_version", default=["SBTS19A"])
+        if isinstance(value, str):
+            value = re.split(r"[,;\s]+", value.strip("[]() "))
+        return [str(version).strip("'\" ") for version in value if str(version).strip("'\" ")]
+
+    @property
+    def sw_attribute(self):
+        return self.get_str("sw_attribute", default="activeSWReleaseVersion")
+
+
+
+
+class DiffEngine(object):
+    """
+    Compares required parameter values with the values read from the network.
+    Every value is converted once to a canonical form: lists such as arfcnValueListGERAN
+    to a sorted tuple, numbers (thresholds) to int or float, everything else to a stripped string.
+    """
 
+    LIST_PARAMS = ("arfcnValueListGERAN",)
 
+    def __init__(self):
+        # keyed by (type, value): True == 1 and hash(True) == hash(1), but they normalize differently
+        self._scalars = {}
+
+    @staticmethod
+    def _number(value):
+        text = str(value).strip()
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            return float(text)
+        except ValueError:
+            return text
+
+    def normalize(self, param, value):
+        """
+        :param param: name of the parameter
+        :param value: value of the parameter
+        :return: canonical form of the value
+        """
+        if param in self.LIST_PARAMS or isinstance(value, (list, tuple, set)):
+            if isinstance(value, str):
+                value = re.findall(r"-?\d+", value)
+            return tuple(sorted((self._number(v) for v in value or ()),
+                                key=lambda v: (isinstance(v, str), v if isinstance(v, str) else float(v))))
+        key = (type(value), value)
+        try:
+            return self._scalars[key]
+        except KeyError:
+            normalized = self._scalars[key] = self._number(value)
+            return normalized
+        except TypeError:
+            return self._number(value)
+
+    def iter_diff(self, checked_obj, etalon_obj):
+        """
+        :param checked_obj: {dn: {param: value}} read from the network
+        :param etalon_obj: {dn: {param: value}} sent to the network
+        :return: generator of (dn, value_is_set, diff_value, obj_not_create) for every dn of etalon_obj,
+            each part has the format of CheckingChanges.check_create_and_update and is empty if not applicable
+        """
+        checked_obj = checked_obj or {}
+        for dn, par_val_etalon in etalon_obj.items():
+            par_val_check = checked_obj.get(dn)
+            if not par_val_check:
+                yield dn, {}, {}, {z: [par_val_etalon[z], "does not exist"] for z in par_val_etalon}
+                continue
+            same = {}
+            different = {}
+            for z, value in par_val_etalon.items():
+                if z not in par_val_check:
+                    different[z] = [value, "N/A"]
+                elif self.normalize(z, par_val_check[z]) == self.normalize(z, value):
+                    same[z] = [value, "OK"]
+                else:
+                    different[z] = [value, par_val_check[z]]
+            yield dn, same, different, {}
 
 
 class CheckingChanges:
@@ -129,58 +366,23 @@ class CheckingChanges:
         diff_value = {}  # this variable contains the value of parameters that differ from the reference
         obj_not_create = {}  # this variable contains parameter values whose objects are missing
 
-        set_dn_checked, set_dn_etalon = self._creator_dn(checked_obj, etalon_obj)
-        if not set_dn_checked:
-            for k in set_dn_etalon:
-                par_val_etalon = etalon_obj.get(k)
-                obj_not_create[k] = {z: [par_val_etalon[z], "does not exist"] for z in par_val_etalon}
-                # not_create_obj[k] = "does not exist"
-            return value_is_set, diff_value, obj_not_create
-
-        missing_dn = set_dn_etalon - set_dn_checked
-        if len(missing_dn) > 0:
-            for k in missing_dn:
-                par_val_etalon = etalon_obj.get(k)
-                obj_not_create[k] = {z: [par_val_etalon[z], "does not exist"] for z in par_val_etalon}
-
-        crossed_dn = set_dn_checked.intersection(set_dn_etalon)
-        if len(crossed_dn) < 1:
-            for k in set_dn_etalon:
-                par_val_etalon = etalon_obj.get(k)
-                obj_not_create[k] = {z: [par_val_etalon[z], "does not exist"] for z in par_val_etalon}
-            return value_is_set, diff_value, obj_not_create
-        else:
-            for i in crossed_dn:
-                par_val_check = checked_obj.get(i)
-                if par_val_check:
-                    set_val_check = set(par_val_check)
-                else:
-                    par_val_etalon = etalon_obj.get(i)
-                    obj_not_create[i] = {z: [par_val_etalon[z], "does not exist"] for z in par_val_etalon}
-                    continue
-
-                par_val_etalon = etalon_obj.get(i)
-                set_val_etalon = set(par_val_etalon)
-
-                crossed_keys = set_val_check.intersection(set_val_etalon)
-                differents = {z: [par_val_etalon[z], par_val_check[z]] for z in crossed_keys if
-                              str(par_val_check[z]) != str(par_val_etalon[z])}
-
-                if differents:
-                    diff_value[i] = differents
-
-                missing_keys = set_val_etalon - set_val_check
-                missing = {z: [par_val_etalon[z], "N/A"] for z in missing_keys if missing_keys}
-                if missing:
-                    diff_value.setdefault(i, {}).update(missing)
-
-                same = {z: [par_val_etalon[z], "OK"] for z in crossed_keys if
-                        str(par_val_check[z]) == str(par_val_etalon[z])}
-                if same:
-                    value_is_set[i] = same
+        for dn, same, different, not_create in self.iter_check_create_and_update(checked_obj, etalon_obj):
+            if same:
+                value_is_set[dn] = same
+            if different:
+                diff_value[dn] = different
+            if not_create:
+                obj_not_create[dn] = not_create
 
         return value_is_set, diff_value, obj_not_create
 
+    def iter_check_create_and_update(self, checked_obj: (list, dict), etalon_obj: (list, dict)):
+        """
+        Lazy version of check_create_and_update
+        :return: generator of (dn, value_is_set, diff_value, obj_not_create) for every dn of etalon_obj
+        """
+        return DiffEngine().iter_diff(checked_obj, etalon_obj)
+
     def check_delete(self, checked_obj, etalon_obj):
 
         obj_del = {}
@@ -206,9 +408,11 @@ class CheckingChanges:
 
 class ReadSetData():
 
-    def __init__(self, script_data):
+    def __init__(self, script_data, amount_in_request=0, max_workers=1, ems=None):
         self.script_data = script_data
-        self.ems = self.script_data.GetEmsService()
+        self.ems = ems or self.script_data.GetEmsService()
+        self.amount_in_request = amount_in_request
+        self.max_workers = max(1, max_workers)
 
     def read_date(self, get_params):
 
@@ -223,9 +427,68 @@ class ReadSetData():
                 for a in o:
                     list_params.append(a)
                 data_preparation[i] = list_params
-        real_val = self.ems.getEMSAttributes(data_preparation)
+
+        real_val = {}
+        list_chunks = chunked(data_preparation, self.amount_in_request)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.ems.getEMSAttributes, {dn: data_preparation[dn] for dn in chunk})
+                       for chunk in list_chunks]
+            for future in futures:
+                real_val.update(future.result() or {})
         return real_val
 
+    def read_for_check(self, changes, push_result, current_values, verify_mode="all", sample_size=100):
+        """
+        Selects and reads the objects to verify after the push
+        :param changes: dict of creates/updates or list of deletes
+        :param push_result: {dn: "OK", error, ChangeBudget.DEFERRED, ChangePlan.STALE reason
+            or PushScheduler.NOT_PUSHED},
+            None if nothing was pushed
+        :param current_values: attributes read from EMS before the push, used instead of reading if nothing was pushed
+        :param verify_mode: "all", "sample" - only sample_size random objects, "none" - nothing is read
+        :param sample_size: number of objects to read in "sample" mode
+        :return: real_val - values from the network,
+            etalon - the part of changes to check with CheckingChanges,
+            unchecked - {dn: reason} for objects that are not checked
+        """
+        if push_result is None:
+            real_val = {dn: current_values[dn] for dn in changes if current_values.get(dn)}
+            return real_val, changes, {}
+
+        unchecked = {}
+        list_dn = []
+        for dn in changes:
+            result = push_result.get(dn, "OK")
+            if result == "OK":
+                list_dn.append(dn)
+            elif (result == ChangeBudget.DEFERRED or result.startswith(ChangePlan.STALE) or
+                  result == PushScheduler.NOT_PUSHED):
+                unchecked[dn] = result
+            else:
+                unchecked[dn] = "push failed: " + result
+        if verify_mode == "none":
+            unchecked.update((dn, "not verified") for dn in list_dn)
+            list_dn = []
+        elif verify_mode == "sample" and len(list_dn) > sample_size:
+            sample = set(random.sample(list_dn, sample_size))
+            unchecked.update((dn, "not verified") for dn in list_dn if dn not in sample)
+            list_dn = [dn for dn in list_dn if dn in sample]
+
+        etalon = list_dn if isinstance(changes, list) else {dn: changes[dn] for dn in list_dn}
+        real_val = self.read_date(etalon) if etalon else {}
+        return real_val, etalon, unchecked
+
+    @staticmethod
+    def unchecked_rows(changes, unchecked):
+        """
+        :param changes: dict of creates/updates or list of deletes
+        :param unchecked: {dn: reason} from read_for_check
+        :return: {dn: {param: [value, reason]}} for creates/updates, {dn: reason} for deletes
+        """
+        if isinstance(changes, list):
+            return unchecked
+        return {dn: {param: [value, reason] for param, value in changes[dn].items()} for dn, reason in unchecked.items()}
+
 
 class ReportGenerator(object):
 
@@ -233,7 +496,9 @@ class ReportGenerator(object):
         self.outputfile = outputfile
         self.start_time = start_time
         self.stop_time = stop_time
+        from enetsdk.Utility import ExcelWrapper
         self.reporter = ExcelWrapper(self.outputfile)
+        self.files = [self.outputfile]
 
     def saved_file(self):
         self.reporter.SaveWorkbook()
@@ -249,10 +514,30 @@ class ReportGenerator(object):
         return self.reporter
 
     def data_transformation(self, dict_to_modify):
+        return list(self.iter_transformation(dict_to_modify))
+
+    def check_rows(self, check_results):
+        return list(self.iter_check_rows(check_results))
 
-        self.dict_to_modify = dict_to_modify
-        date_complited = []
-        for key_to, val_to in self.dict_to_modify.items():
+    @classmethod
+    def iter_check_rows(cls, check_results):
+        """
+        :param check_results: (dn, value_is_set, diff_value, obj_not_create) from CheckingChanges.iter_check_create_and_update
+        :return: generator of report rows
+        """
+        for check_result in check_results:
+            dn = check_result[0]
+            for part in check_result[1:]:
+                if part:
+                    yield from cls.iter_transformation({dn: part})
+
+    @staticmethod
+    def iter_transformation(dict_to_modify):
+        """
+        :param dict_to_modify: {dn: {param: [value, result]}}, {dn: [value, ...]} or {dn: result}
+        :return: generator of report rows
+        """
+        for key_to, val_to in dict_to_modify.items():
             if isinstance(val_to, dict):
                 for params_val in val_to.items():
                     d = []
@@ -267,48 +552,1672 @@ class ReportGenerator(object):
                                     d.append(z)
                         else:
                             d.append(i)
-                    date_complited.append(d)
+                    yield d
             elif isinstance(val_to, list):
                 d = []
                 d.append(key_to)
                 d.extend([', '.join(str(e) for e in val_to)])
-                date_complited.append(d)
+                yield d
             else:
                 d = []
                 d.append(key_to)
                 d.append(val_to)
-                date_complited.append(d)
+                yield d
+
 
-        return date_complited
+class StreamingReportGenerator(ReportGenerator):
+    """
+    Writes report rows as they are added, without keeping them in memory.
+    report_format "xlsx_stream" - openpyxl workbook in write-only mode,
+    "csv" - one csv file per sheet, "jsonl" - one json object per row in a single file.
+    """
+
+    FORMATS = ("xlsx_stream", "csv", "jsonl")
+
+    def __init__(self, outputfile, start_time, stop_time, report_format="xlsx_stream"):
+        self.outputfile = outputfile
+        self.start_time = start_time
+        self.stop_time = stop_time
+        self.report_format = report_format
+        self.base_name = os.path.splitext(outputfile)[0]
+        self.headers = {}
+        self.writers = {}
+        self.streams = []
+        self.current_sheet = None
+        self.files = []
+        if report_format == "xlsx_stream":
+            import openpyxl
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.files.append(self.outputfile)
+        elif report_format == "jsonl":
+            self.files.append(self.base_name + ".jsonl")
+            self.streams.append(open(self.files[-1], "w", encoding="utf-8"))
+
+    @staticmethod
+    def _cell_value(value):
+        return value if value is None or isinstance(value, (str, int, float)) else str(value)
+
+    def create_new_sheets(self, name_sheet, header: list):
+        self.headers[name_sheet] = list(header)
+        if self.report_format == "xlsx_stream":
+            import openpyxl
+            sheet = self.workbook.create_sheet(name_sheet)
+            cells = []
+            for h in header:
+                cell = openpyxl.cell.WriteOnlyCell(sheet, value=h)
+                cell.fill = openpyxl.styles.PatternFill("solid", fgColor="FFFF6600")
+                cells.append(cell)
+            sheet.append(cells)
+            self.writers[name_sheet] = sheet
+        elif self.report_format == "csv":
+            self.files.append(self.base_name + "_" + name_sheet + ".csv")
+            stream = open(self.files[-1], "w", encoding="utf-8", newline="")
+            self.streams.append(stream)
+            self.writers[name_sheet] = csv.writer(stream)
+            self.writers[name_sheet].writerow(header)
+        self.current_sheet = name_sheet
+        return self
+
+    def UseSheet(self, name_sheet):
+        self.current_sheet = name_sheet
+
+    def AddData(self, rows):
+        if self.report_format == "jsonl":
+            header = self.headers[self.current_sheet]
+            stream = self.streams[0]
+            for row in rows:
+                record = {"Sheet": self.current_sheet}
+                record.update(zip(header, (self._cell_value(v) for v in row)))
+                stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+            return
+        writer = self.writers[self.current_sheet]
+        for row in rows:
+            if self.report_format == "xlsx_stream":
+                writer.append([self._cell_value(v) for v in row])
+            else:
+                writer.writerow(row)
+
+    def data_transformation(self, dict_to_modify):
+        return self.iter_transformation(dict_to_modify)
+
+    def check_rows(self, check_results):
+        return self.iter_check_rows(check_results)
+
+    def quick_builder(self, date):
+        # QuickBuild belongs to ExcelWrapper, which a streaming report does not use
+        raise NotImplementedError("quick_builder needs report_format xlsx, not {}".format(self.report_format))
+
+    def saved_file(self):
+        if self.report_format == "xlsx_stream":
+            self.workbook.save(self.outputfile)
+        for stream in self.streams:
+            stream.close()
+        return all(os.path.exists(f) for f in self.files)
+
+
+class TemplateConfig(NamedTuple):
+    """
+    Compiled Custom_Configuration template
+    """
+    fingerprint: str
+    params: dict  # LNHOG parameters, b2Threshold1GERAN and b2Threshold1GERANQci1 as dicts {band_bandwidth: value}
+    extra_bands: dict  # additional bands {band: [first earfcn, last earfcn]}
+
+
+class TemplateLoader(object):
+    """
+    Loads the Custom_Configuration template.
+    The compiled template is cached in memory and in cache_file by the sha256 of the raw file,
+    an unchanged template is not opened with openpyxl again.
+    """
+
+    _compiled = {}
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+
+    @staticmethod
+    def raw_bytes(io_stream, filename):
+        """
+        :param io_stream: raw config file from GetConfig: bytes or file-like object
+        :param filename: file name of the template, used if io_stream is empty
+        :return: content of the template
+        """
+        if isinstance(io_stream, (bytes, bytearray)):
+            return bytes(io_stream)
+        if io_stream is not None and hasattr(io_stream, "read"):
+            if hasattr(io_stream, "seek"):
+                io_stream.seek(0)
+            return io_stream.read()
+        with open(filename, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def compile(data, fingerprint):
+        """
+        :param data: content of the template
+        :param fingerprint: sha256 of data
+        :return: TemplateConfig
+        """
+        import openpyxl
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+        try:
+            params = parser_exel(wb)
+        finally:
+            wb.close()
+        for param in BandResolver.THRESHOLD_PARAMS:
+            params[param] = json.loads(params.get(param))
+        extra_bands = params.pop(TEMPLATE_BANDS_PARAM, None)
+        if isinstance(extra_bands, str):
+            extra_bands = json.loads(extra_bands)
+        return TemplateConfig(fingerprint, params, extra_bands or {})
+
+    def _read_cache(self, fingerprint):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Template cache {} is not readable: {}".format(self.cache_file, e))
+            return None
+        if cached.get("fingerprint") != fingerprint:
+            return None
+        return TemplateConfig(fingerprint, cached["params"], cached["extra_bands"])
+
+    def _write_cache(self, template):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(template._asdict(), f)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+        except (OSError, TypeError, ValueError) as e:
+            print("Template cache {} is not written: {}".format(self.cache_file, e))
+
+    def load(self, io_stream, filename):
+        """
+        :param io_stream: raw config file from GetConfig
+        :param filename: file name of the template
+        :return: TemplateConfig
+        """
+        data = self.raw_bytes(io_stream, filename)
+        fingerprint = hashlib.sha256(data).hexdigest()
+        template = self._compiled.get(fingerprint)
+        if template is None:
+            template = self._read_cache(fingerprint)
+            if template is None:
+                template = self.compile(data, fingerprint)
+                self._write_cache(template)
+                print("Template {} compiled".format(filename))
+            self._compiled[fingerprint] = template
+        return template
+
+
+def peak_memory_mb():
+    """
+    :return: peak resident memory of the process in MB, None if not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024.0 / (1024.0 if sys.platform == "darwin" else 1.0), 1)
+
+
+def current_memory_mb():
+    """
+    :return: resident memory of the process now in MB (from /proc/self/statm, or psutil
+        where there is no /proc), None if not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024.0 / 1024.0, 1)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return round(psutil.Process().memory_info().rss / 1024.0 / 1024.0, 1)
+
+
+# estimated memory of one target cell during planning: topology, EMS results and CellState
+# Estimates, not limits: Python heap per target cell measured with
+# benchmarks/bench_lnhog_change.py --trace-memory (10-80 neighbors, 2-30% changed cells)
+# plus allocator overhead. CELL_MEMORY_KB - whole run at once (measured 1.1-2.2 KB),
+# CELL_RESIDENT_KB - part kept for the whole run in pipeline_mode: plan, verification, caches (0.3-0.6 KB)
+CELL_MEMORY_KB = 4
+CELL_RESIDENT_KB = 1
+
+
+def chunk_cells_for_memory(memory_limit_mb, number_of_cells, chunks_in_flight):
+    """
+    :param memory_limit_mb: memory ceiling of the run
+    :param number_of_cells: number of target cells
+    :param chunks_in_flight: number of chunks held at once by the pipeline
+    :return: number of cells per chunk that keeps the run under the ceiling by the estimate,
+        0 if all cells can be processed at once; at least 100 cells even if the plan of all cells
+        alone does not fit
+    """
+    # memory in use now, not the peak: memory freed by an earlier run of the process is available again
+    available_kb = (memory_limit_mb - (current_memory_mb() or 0)) * 1024
+    if number_of_cells * CELL_MEMORY_KB <= available_kb:
+        return 0
+    available_kb -= number_of_cells * CELL_RESIDENT_KB
+    return max(100, int(available_kb / (CELL_MEMORY_KB - CELL_RESIDENT_KB) / chunks_in_flight))
+
+
+class RunMetrics(object):
+    """
+    Wall time, EMS calls and peak memory of the phases of ScriptMain.
+    EMS clients wrapped with wrap() count their calls in the current phase.
+    """
+
+    EMS_METHODS = ("get_child_attributes", "push_ems_attributes_by_oss", "getEMSAttributes")
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.current_phase = None
+        self._lock = threading.Lock()
+
+    def _phase_metrics(self, name):
+        return self.phases.setdefault(name, {"wall_time": 0.0, "peak_memory_mb": None, "ems_calls": {}})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        previous, self.current_phase = self.current_phase, name
+        try:
+            yield
+        finally:
+            self.current_phase = previous
+            phase_metrics = self._phase_metrics(name)
+            phase_metrics["wall_time"] = round(phase_metrics["wall_time"] + time.time() - start, 3)
+            phase_metrics["peak_memory_mb"] = peak_memory_mb()
+
+    def count_call(self, method, dns):
+        with self._lock:
+            calls = self._phase_metrics(self.current_phase or "other")["ems_calls"]
+            stat = calls.setdefault(method, {"calls": 0, "dns": 0, "max_dns_per_call": 0})
+            stat["calls"] += 1
+            stat["dns"] += dns
+            stat["max_dns_per_call"] = max(stat["max_dns_per_call"], dns)
+
+    def wrap(self, ems_client):
+        return CountingEmsClient(ems_client, self)
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def as_dict(self):
+        ems_calls = {}
+        for phase_metrics in self.phases.values():
+            for method, stat in phase_metrics["ems_calls"].items():
+                total = ems_calls.setdefault(method, {"calls": 0, "dns": 0, "max_dns_per_call": 0})
+                total["calls"] += stat["calls"]
+                total["dns"] += stat["dns"]
+                total["max_dns_per_call"] = max(total["max_dns_per_call"], stat["max_dns_per_call"])
+        for stat in ems_calls.values():
+            stat["dns_per_call"] = round(stat["dns"] / float(stat["calls"]), 1)
+        return {"wall_time": round(time.time() - self.start, 3), "peak_memory_mb": peak_memory_mb(),
+                "counters": self.counters, "ems_calls": ems_calls, "phases": self.phases}
+
+    def save(self, path):
+        """
+        :param path: path of the json file
+        :return: True if the file is written
+        """
+        try:
+            with open(path, "w") as f:
+                json.dump(self.as_dict(), f, indent=2, default=str)
+        except (OSError, TypeError, ValueError) as e:
+            print("Metrics file {} is not written: {}".format(path, e))
+            return False
+        return True
+
+
+class CountingEmsClient(object):
+    """
+    Proxy of an EMS client that reports every EMS call and the number of dns in it to RunMetrics
+    """
+
+    def __init__(self, ems_client, metrics):
+        self._ems_client = ems_client
+        self._metrics = metrics
+
+    @staticmethod
+    def _dns(args, kwargs):
+        if kwargs.get("updates") is not None or kwargs.get("creates") is not None or kwargs.get("deletes") is not None:
+            return sum(len(kwargs.get(k) or ()) for k in ("updates", "creates", "deletes"))
+        return len(args[0]) if args and hasattr(args[0], "__len__") else 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self._ems_client, name)
+        if name not in RunMetrics.EMS_METHODS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._metrics.count_call(name, self._dns(args, kwargs))
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def chunked(list_dn, size):
+    """
+    Splits the list into parts
+    :param list_dn: list of dn
+    :param size: maximum number of dn in one part, the whole list is one part if size < 1
+    :return: list of lists
+    """
+    list_dn = list(list_dn)
+    if size < 1:
+        return [list_dn] if list_dn else []
+    return [list_dn[i:i + size] for i in range(0, len(list_dn), size)]
+
+
+class DnKey(NamedTuple):
+    """
+    Parsed dn of an object on an LTE cell, e.g. PLMN-PLMN/MRBTS-1/LNBTS-1/LNCEL-2/LNHOG-0:
+    mrbts, lnbts, lncel - ids of the objects, cell - dn of LNCEL, mrbts_dn - dn of MRBTS,
+    child_class and instance - class and id of the child of LNCEL, "" and None for the cell itself.
+    Parts missing from the dn are "" (and None for instance), e.g. cell of an MRBTS dn
+    """
+    mrbts: str
+    lnbts: str
+    lncel: str
+    child_class: str
+    instance: Any
+    cell: str
+    mrbts_dn: str
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def parse_dn(dn):
+    """
+    Parses the dn once, the result is cached until clear_dn_caches() at the end of the run
+    :param dn: dn of MRBTS, LNCEL or of a child of LNCEL
+    :return: DnKey
+    """
+    parts = dn.split("/")
+    ids = {}
+    positions = {}
+    for position, part in enumerate(parts):
+        object_class, _, object_id = part.partition("-")
+        ids.setdefault(object_class, object_id)
+        positions.setdefault(object_class, position)
+    cell, child_class, instance = "", "", None
+    position_cell = positions.get("LNCEL")
+    if position_cell is not None:
+        cell = sys.intern("/".join(parts[:position_cell + 1]))
+        if position_cell < len(parts) - 1:
+            child_class, _, child_id = parts[-1].partition("-")
+            instance = int(child_id) if child_id.isdigit() else child_id
+    position_mrbts = positions.get("MRBTS")
+    mrbts_dn = sys.intern("/".join(parts[:position_mrbts + 1])) if position_mrbts is not None else ""
+    return DnKey(ids.get("MRBTS", ""), ids.get("LNBTS", ""), ids.get("LNCEL", ""), child_class, instance,
+                 cell, mrbts_dn)
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def lnhog_dn(dn_cell, instance=0):
+    """
+    :param dn_cell: dn of LNCEL
+    :return: interned dn of the LNHOG instance of the cell
+    """
+    return sys.intern("{}/LNHOG-{}".format(dn_cell, instance))
+
+
+def clear_dn_caches():
+    """
+    Empties the caches of parse_dn and lnhog_dn, the module stays loaded in the framework between runs
+    """
+    parse_dn.cache_clear()
+    lnhog_dn.cache_clear()
+
+
+def chunked_by_mrbts(items, size, dn_of=lambda item: item):
+    """
+    Splits the items into parts like chunked, but keeps the items of one MRBTS in one part:
+    the items are grouped by MRBTS in the order of their first appearance and the groups are packed
+    into parts of at most size items. Only a group larger than size is split.
+    :param items: dns or objects with a dn
+    :param size: maximum number of items in one part, all items are one part if size < 1
+    :param dn_of: returns the dn of an item
+    :return: list of lists
+    """
+    groups = collections.OrderedDict()
+    for item in items:
+        groups.setdefault(parse_dn(dn_of(item)).mrbts_dn, []).append(item)
+    if size < 1:
+        return [[item for group in groups.values() for item in group]] if groups else []
+    parts = []
+    part = []
+    for group in groups.values():
+        if part and len(part) + len(group) > size:
+            parts.append(part)
+            part = []
+        for piece in chunked(group, size):
+            if len(piece) == size:
+                parts.append(piece)
+            else:
+                part.extend(piece)
+    if part:
+        parts.append(part)
+    return parts
+
+
+class EmsReader(object):
+    """
+    Reads child objects of the target cells from EMS.
+    The target dns are split into requests of amount_in_request dns, the requests of all
+    object classes are sent concurrently by a bounded number of workers.
+    """
+
+    def __init__(self, ems_client, amount_in_request, max_workers):
+        self.ems_client = ems_client
+        self.amount_in_request = amount_in_request
+        self.max_workers = max(1, max_workers)
+
+    def _read_chunk(self, list_dn, child_class, attributes):
+        return self.ems_client.get_child_attributes(list_dn, child_class, {child_class: attributes},
+                                                    return_by_dn=False)
+
+    def get_child_attributes(self, list_dn, requests):
+        """
+        :param list_dn: dn of the target cells
+        :param requests: dict {child_class: [attribute_1, attribute_2, ...]}
+        :return: dict {child_class: {dn_child: {attribute: value}}}
+        """
+        list_chunks = chunked(list_dn, self.amount_in_request)
+        result = {child_class: {} for child_class in requests}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(child_class, executor.submit(self._read_chunk, chunk, child_class, attributes))
+                       for child_class, attributes in requests.items() for chunk in list_chunks]
+            for child_class, future in futures:
+                result[child_class].update(future.result() or {})
+        print("EMS read: {} dns in {} requests per object class".format(len(list_dn), len(list_chunks)))
+        return result
+
+
+class SwVersionFilter(object):
+    """
+    Implements check_sw: the software version of every MRBTS of the target cells is read once
+    in one chunked bulk read, and cells of base stations on other versions than sw_version are dropped
+    before any neighbor or LNHOG work. Cells of base stations without a readable version are kept.
+    """
+
+    def __init__(self, reader, versions, attribute):
+        """
+        :param reader: ReadSetData
+        :param versions: supported versions, e.g. ["SBTS19A"]; a version matches if it starts with one of them
+        :param attribute: MRBTS attribute with the software version
+        """
+        self.reader = reader
+        self.versions = tuple(version.upper() for version in versions)
+        self.attribute = attribute
+        self._mrbts_versions = {}
+
+    def mrbts_versions(self, list_dn_mrbts):
+        """
+        :param list_dn_mrbts: dn of MRBTS
+        :return: {dn_mrbts: version} for the MRBTS with a readable version, read once per run
+        """
+        missing = [dn for dn in list_dn_mrbts if dn not in self._mrbts_versions]
+        if missing:
+            values = self.reader.read_date({dn: [self.attribute] for dn in missing})
+            for dn in missing:
+                self._mrbts_versions[dn] = (values.get(dn) or {}).get(self.attribute)
+        return {dn: self._mrbts_versions[dn] for dn in list_dn_mrbts if self._mrbts_versions[dn] is not None}
+
+    def is_supported(self, version):
+        return str(version).strip().upper().startswith(self.versions)
+
+    def supported(self, cells):
+        """
+        :param cells: target cells
+        :return: target cells of base stations on a supported version
+        """
+        versions = self.mrbts_versions(sorted({parse_dn(cell.dn).mrbts_dn for cell in cells}))
+        unsupported = {dn for dn, version in versions.items() if not self.is_supported(version)}
+        supported_cells = [cell for cell in cells if parse_dn(cell.dn).mrbts_dn not in unsupported]
+        print("Check SW {}: {} MRBTS on other versions, {} of {} cells skipped".format(
+            list(self.versions), len(unsupported), len(cells) - len(supported_cells), len(cells)))
+        return supported_cells
+
+
+class AdminStateFilter(object):
+    """
+    Implements Audit Type "Unlocked cell only": the administrative state of all target cells
+    is read in one chunked bulk read, and locked cells are dropped before any neighbor or LNHOG work.
+    Cells without a readable state are kept.
+    """
+
+    ATTRIBUTE = "administrativeState"
+
+    def __init__(self, reader):
+        """
+        :param reader: ReadSetData
+        """
+        self.reader = reader
+
+    @staticmethod
+    def is_unlocked(state):
+        """
+        :param state: administrativeState as read from EMS, e.g. "unlocked", "1" or "1 (unlocked)"
+        """
+        text = str(state).strip().lower()
+        return text == "1" or "unlocked" in text
+
+    def unlocked(self, cells):
+        """
+        :param cells: target cells
+        :return: target cells that are not locked
+        """
+        states = self.reader.read_date({cell.dn: [self.ATTRIBUTE] for cell in cells})
+        unlocked_cells = []
+        unknown = 0
+        for cell in cells:
+            state = (states.get(cell.dn) or {}).get(self.ATTRIBUTE)
+            if state is None:
+                unknown += 1
+                unlocked_cells.append(cell)
+            elif self.is_unlocked(state):
+                unlocked_cells.append(cell)
+        print("Audit Type Unlocked cell only: {} of {} cells are locked, state of {} cells unknown".format(
+            len(cells) - len(unlocked_cells), len(cells), unknown))
+        return unlocked_cells
+
+
+class BandTable(object):
+    """
+    Sorted EARFCN ranges of the LTE bands, the band of a channel is found by bisection
+    """
+
+    def __init__(self, extra_bands=None):
+        """
+        :param extra_bands: dict {band: [first earfcn, last earfcn]} added to BAND_EARFCN_RANGES,
+            a band with the same name replaces the built-in one
+        """
+        ranges = {band: (first, last) for first, last, band in BAND_EARFCN_RANGES}
+        for band, (first, last) in (extra_bands or {}).items():
+            first, last = int(first), int(last)
+            overlapped = [name for name, (f, l) in ranges.items() if name != band and f <= last and first <= l]
+            if overlapped:
+                print("Band {} {}-{} overlaps {}, skipped".format(band, first, last, ", ".join(overlapped)))
+                continue
+            ranges[band] = (first, last)
+
+        self.ranges = sorted((first, last, band) for band, (first, last) in ranges.items())
+        self.starts = [first for first, _, _ in self.ranges]
+
+    def band(self, channel):
+        """
+        :param channel: earfcn
+        :return: e.g. "LTE_1800", "Unknown" if channel is outside of all bands
+        """
+        position = bisect.bisect_right(self.starts, channel) - 1
+        if position >= 0 and channel <= self.ranges[position][1]:
+            return self.ranges[position][2]
+        return "Unknown"
+
+
+class ArfcnSet(object):
+    """
+    Set of GSM ARFCNs (0-1023) stored as the bits of an int.
+    Equality and difference of two sets are single integer operations.
+    """
+
+    @staticmethod
+    def from_values(values):
+        """
+        :param values: ARFCNs as int or str, e.g. arfcnValueListGERAN from EMS
+        :return: bitset, values that are not integers are ignored
+        """
+        if isinstance(values, str):
+            values = re.findall(r"\d+", values)
+        bits = 0
+        for value in values or ():
+            try:
+                bits |= 1 << int(str(value).strip())
+            except ValueError:
+                continue
+        return bits
+
+    @staticmethod
+    def to_list(bits):
+        """
+        :param bits: bitset
+        :return: sorted list of ARFCNs as str, the format of arfcnValueListGERAN
+        """
+        values = []
+        while bits:
+            lowest = bits & -bits
+            values.append(str(lowest.bit_length() - 1))
+            bits ^= lowest
+        return values
+
+
+class BcchCache(object):
+    """
+    BCCH of the GSM neighbors keyed by GSM cell dn, shared by all target cells of a run.
+    bcch_frequency of every GSM cell is read once; with cache_file the values are kept
+    between runs and read again after ttl seconds.
+    """
+
+    def __init__(self, cache_file="", ttl=0):
+        """
+        :param cache_file: json file of the cache, not persisted if empty
+        :param ttl: lifetime of a persisted value in seconds
+        """
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.values = {}
+        self.updated = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            print("BCCH cache {} is not readable: {}".format(self.cache_file, e))
+            return
+        expired = time.time() - self.ttl
+        for dn_gsm, (bcch, updated) in cached.items():
+            if updated >= expired:
+                dn_gsm = sys.intern(dn_gsm)
+                self.values[dn_gsm] = int(bcch, 16)
+                self.updated[dn_gsm] = updated
+
+    def save(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({dn_gsm: [format(bcch, "x"), self.updated[dn_gsm]]
+                           for dn_gsm, bcch in self.values.items()}, f)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+        except (OSError, TypeError, ValueError) as e:
+            print("BCCH cache {} is not written: {}".format(self.cache_file, e))
+
+    def resolve(self, neighbor):
+        """
+        :param neighbor: GSM neighbor from GetNeighbors
+        :return: interned dn of the neighbor, its BCCH is in values
+        """
+        dn_gsm = sys.intern(neighbor.dn)
+        if dn_gsm in self.values:
+            with self._lock:
+                self.hits += 1
+            return dn_gsm
+        bcch = ArfcnSet.from_values((neighbor.bcch_frequency,))
+        with self._lock:
+            self.misses += 1
+            self.values[dn_gsm] = bcch
+            self.updated[dn_gsm] = time.time()
+        return dn_gsm
+
+
+class TopologyIndex(object):
+    """
+    In-memory IRAT LTE -> GSM adjacency of the target cells.
+    The framework exposes neighbors only per cell, so the target cells are loaded in chunks
+    on a pool of threads and the round trips of a chunk overlap.
+    lte - {dn LTE cell: (dn GSM cell, ...)}, the BCCH of every GSM cell is kept once in bcch_cache.
+    """
+
+    def __init__(self, bcch_cache=None):
+        """
+        :param bcch_cache: BcchCache, a new cache of this run if not set
+        """
+        self.lte = {}
+        self.bcch_cache = bcch_cache or BcchCache()
+
+    def _load_chunk(self, cells):
+        adjacency = []
+        for cell in cells:
+            gsm = tuple(self.bcch_cache.resolve(neighbor)
+                        for neighbor in cell.GetNeighbors(neighborType="irat", ignore_missing_data=True)
+                        if neighbor.technology == "GSM")
+            adjacency.append((cell.dn, gsm))
+        return adjacency
+
+    @classmethod
+    def load(cls, cells, chunk_size, max_workers, bcch_cache=None):
+        """
+        :param cells: target cells
+        :param chunk_size: number of cells loaded by one task
+        :param max_workers: number of threads
+        :param bcch_cache: BcchCache shared with earlier loads or runs
+        :return: TopologyIndex
+        """
+        index = cls(bcch_cache)
+        list_chunks = chunked(cells, chunk_size)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for adjacency in executor.map(index._load_chunk, list_chunks):
+                for dn_cell, gsm in adjacency:
+                    index.lte[sys.intern(dn_cell)] = gsm
+        print("Topology: {} LTE cells in {} chunks, BCCH cache: {} hits, {} misses".format(
+            len(index.lte), len(list_chunks), index.bcch_cache.hits, index.bcch_cache.misses))
+        return index
+
+    def cell_bcch(self, dn_cell):
+        """
+        :return: ArfcnSet of the BCCH of the GSM neighbors of the LTE cell
+        """
+        values = self.bcch_cache.values
+        bits = 0
+        for dn_gsm in self.lte.get(dn_cell, ()):
+            bits |= values[dn_gsm]
+        return bits
+
+
+class CellState(object):
+    """
+    Planning state of one target cell, keyed by the dn of its LNHOG-0.
+    The states of all target cells are the only copy of the EMS results kept during planning.
+    bcch - ArfcnSet of the BCCH of the GSM neighbors, 0 if the cell has no GSM neighbors
+    lnhog - current LNHOG-0 attributes, None if LNHOG-0 does not exist
+    carrier - LNCEL_FDD/LNCEL_TDD attributes
+    other_lnhog - ((dn, attributes), ...) of the other LNHOG instances of the cell
+    """
+
+    __slots__ = ("dn", "bcch", "lnhog", "carrier", "other_lnhog")
+
+    def __init__(self, dn, bcch=0, lnhog=None, carrier=None, other_lnhog=()):
+        self.dn = dn
+        self.bcch = bcch
+        self.lnhog = lnhog
+        self.carrier = carrier
+        self.other_lnhog = other_lnhog
+
+    @property
+    def dn_cell(self):
+        return parse_dn(self.dn).cell
+
+    @classmethod
+    def build(cls, list_dn_cell, dict_dn_cell_bcch, dict_ems):
+        """
+        Moves the EMS results into the states: dict_ems and dict_dn_cell_bcch are emptied,
+        so no object is held twice
+        :param list_dn_cell: dn of the target cells
+        :param dict_dn_cell_bcch: {dn_lnhog: ArfcnSet} from LnhogPlanner.collect_bcch
+        :param dict_ems: {"LNHOG": {dn: attributes}, "LNCEL_FDD": {...}, "LNCEL_TDD": {...}} from EmsReader
+        :return: {dn_lnhog: CellState}
+        """
+        cell_states = {}
+        # index of the states by dn of LNCEL
+        by_cell = {}
+
+        def state_of(dn_cell):
+            state = by_cell.get(dn_cell)
+            if state is None:
+                dn = lnhog_dn(dn_cell)
+                state = by_cell[dn_cell] = cell_states[dn] = cls(dn, dict_dn_cell_bcch.pop(dn, 0))
+            return state
+
+        for dn_cell in list_dn_cell:
+            state_of(parse_dn(dn_cell).cell)
+        for child_class in CARRIER_ATTRIBUTES:
+            dict_carrier = dict_ems.pop(child_class, None) or {}
+            while dict_carrier:
+                dn_carrier, value_carrier = dict_carrier.popitem()
+                state_of(parse_dn(dn_carrier).cell).carrier = value_carrier
+        dict_lnhog_param = dict_ems.pop("LNHOG", None) or {}
+        while dict_lnhog_param:
+            dn_lnhog, value_lnhog = dict_lnhog_param.popitem()
+            key = parse_dn(dn_lnhog)
+            state = state_of(key.cell)
+            if key.instance == 0:
+                state.lnhog = value_lnhog or {}
+            else:
+                state.other_lnhog += ((sys.intern(dn_lnhog), value_lnhog),)
+        dict_dn_cell_bcch.clear()
+        return cell_states
+
+    @staticmethod
+    def current_values(cell_states, list_dn):
+        """
+        :param cell_states: {dn_lnhog: CellState}
+        :param list_dn: dn of LNHOG, e.g. of the planned changes
+        :return: {dn: attributes} of the existing LNHOG from list_dn, as read from EMS
+        """
+        wanted = set(list_dn)
+        current_values = {}
+        for dn, state in cell_states.items():
+            if dn in wanted and state.lnhog is not None:
+                current_values[dn] = state.lnhog
+            for dn_other, value_other in state.other_lnhog:
+                if dn_other in wanted:
+                    current_values[dn_other] = value_other
+        return current_values
+
+
+class BandResolver(object):
+    """
+    Resolves band, bandwidth and b2 thresholds of the target cells.
+    Results are cached per LNHOG dn, so every cell is resolved once per run.
+    """
+
+    THRESHOLD_PARAMS = ("b2Threshold1GERANQci1", "b2Threshold1GERAN")
+
+    def __init__(self, default_param, band_table=None):
+        """
+        :param default_param: parameters from the template, thresholds already parsed into dicts
+        :param band_table: BandTable, built-in bands if not set
+        """
+        self.default_param = default_param
+        self.band_table = band_table or BandTable()
+        self._band_bandwidth = {}
+        self._thresholds = {}
+
+    def band_bandwidth(self, dn_lnhog, carrier):
+        """
+        :param dn_lnhog: dn of LNHOG
+        :param carrier: LNCEL_FDD/LNCEL_TDD attributes of the cell
+        :return: band_bandwidth e.g. "LTE_1800_20"
+        """
+        band_bandwidth = self._band_bandwidth.get(dn_lnhog)
+        if band_bandwidth is None:
+            band_bandwidth = band_bw(dn_lnhog, {dn_lnhog: carrier}, self.band_table)
+            self._band_bandwidth[dn_lnhog] = band_bandwidth
+        return band_bandwidth
+
+    def thresholds(self, dn_lnhog, carrier):
+        """
+        :param dn_lnhog: dn of LNHOG
+        :param carrier: LNCEL_FDD/LNCEL_TDD attributes of the cell
+        :return: {"b2Threshold1GERANQci1": value, "b2Threshold1GERAN": value} for the band of the cell
+        """
+        thresholds = self._thresholds.get(dn_lnhog)
+        if thresholds is None:
+            band_bandwidth = self.band_bandwidth(dn_lnhog, carrier)
+            thresholds = {param: self.default_param.get(param).get(band_bandwidth, -120)
+                          for param in self.THRESHOLD_PARAMS if param in self.default_param}
+            self._thresholds[dn_lnhog] = thresholds
+        return thresholds
+
+
+class LnhogPlanner(object):
+    """
+    Builds the BCCH set of every target LNHOG and the create/update/delete plan.
+    Every target cell and every LNHOG read from EMS is visited once.
+    """
+
+    THRESHOLD_PARAMS = BandResolver.THRESHOLD_PARAMS
+
+    def __init__(self, default_param, band_resolver):
+        """
+        :param default_param: parameters from the template, thresholds already parsed into dicts
+        :param band_resolver: BandResolver of the target cells
+        """
+        self.default_param = default_param
+        self.band_resolver = band_resolver
+
+    @classmethod
+    def collect_bcch(cls, topology):
+        """
+        :param topology: TopologyIndex of the target cells
+        :return: list_dn_cell - dn of all target cells,
+            dict_dn_cell_bcch - {dn_lnhog: ArfcnSet of the BCCH} for cells with GSM neighbors
+        """
+        list_dn_cell = list(topology.lte)
+        dict_dn_cell_bcch = {}
+        for dn_cell in list_dn_cell:
+            bcch = topology.cell_bcch(dn_cell)
+            if bcch:
+                dict_dn_cell_bcch[lnhog_dn(dn_cell)] = bcch
+        return list_dn_cell, dict_dn_cell_bcch
+
+    def update_params(self, state):
+        """
+        :param state: CellState with existing LNHOG-0
+        :return: dict of parameters to correct, empty if LNHOG is correct
+        """
+        changes = {}
+        for key, value in state.lnhog.items():
+            if key in self.THRESHOLD_PARAMS:
+                thresholds = self.band_resolver.thresholds(state.dn, state.carrier)
+                if value != str(thresholds.get(key)):
+                    changes[key] = str(thresholds.get(key))
+            elif key == "arfcnValueListGERAN":
+                if ArfcnSet.from_values(value) != state.bcch:
+                    changes[key] = ArfcnSet.to_list(state.bcch)
+            elif value != str(self.default_param.get(key)):
+                changes[key] = str(self.default_param.get(key))
+        return changes
+
+    def create_params(self, state):
+        """
+        :param state: CellState without LNHOG-0
+        :return: all parameters of the LNHOG to create
+        """
+        params = dict(self.default_param)
+        params["arfcnValueListGERAN"] = ArfcnSet.to_list(state.bcch)
+        params.update(self.band_resolver.thresholds(state.dn, state.carrier))
+        return params
+
+    def plan(self, cell_states):
+        """
+        :param cell_states: {dn_lnhog: CellState} from CellState.build
+        :return: create - {dn: {param: value}}, update - {dn: {param: value}}, delete - [dn, ...]
+        """
+        create = {}
+        update = {}
+        delete = []
+        for dn, state in cell_states.items():
+            if state.bcch:
+                if state.lnhog is None:
+                    create[dn] = self.create_params(state)
+                else:
+                    changes = self.update_params(state)
+                    if changes:
+                        update[dn] = changes
+            delete.extend(dn_other for dn_other, _ in state.other_lnhog)
+        return create, update, delete
+
+
+class SnapshotStore(object):
+    """
+    SQLite store of the last seen inputs of the target cells: template and BCCH of the GSM neighbors.
+    Only cells for which no changes were planned are stored, so a cell with an unchanged,
+    not expired entry does not need to be read from EMS and planned again.
+    """
+
+    SELECT_SIZE = 500
+
+    def __init__(self, path, ttl):
+        """
+        :param path: path of the SQLite file
+        :param ttl: lifetime of an entry in seconds
+        """
+        self.path = path
+        self.ttl = ttl
+        import sqlite3
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cell_snapshot ("
+                                "dn TEXT PRIMARY KEY, template TEXT, bcch TEXT, updated REAL)")
+        self.connection.commit()
+
+    @staticmethod
+    def fingerprint(value):
+        """
+        :param value: any json serializable value
+        :return: sha1 of the value
+        """
+        return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _bcch(bcch):
+        return format(bcch or 0, "x")
+
+    def changed_cells(self, list_dn_cell, dict_dn_cell_bcch, template):
+        """
+        :param list_dn_cell: dn of the target cells
+        :param dict_dn_cell_bcch: {dn_lnhog: ArfcnSet} from LnhogPlanner.collect_bcch
+        :param template: fingerprint of the template
+        :return: dn of the cells without a valid entry or with changed neighbors
+        """
+        expired = time.time() - self.ttl
+        stored = {}
+        with self._lock:
+            for part in chunked(list_dn_cell, self.SELECT_SIZE):
+                query = "SELECT dn, template, bcch, updated FROM cell_snapshot WHERE dn IN ({})".format(
+                    ",".join("?" * len(part)))
+                stored.update((dn, (template_dn, bcch, updated)) for dn, template_dn, bcch, updated in
+                              self.connection.execute(query, part))
+        changed = []
+        for dn_cell in list_dn_cell:
+            entry = stored.get(dn_cell)
+            if (entry is None or entry[0] != template or entry[2] < expired or
+                    entry[1] != self._bcch(dict_dn_cell_bcch.get(lnhog_dn(dn_cell)))):
+                changed.append(dn_cell)
+        return changed
+
+    def save(self, cell_states, template, create, update, delete):
+        """
+        Stores the inputs of the cells without planned changes and removes the entries of the others
+        :param cell_states: {dn_lnhog: CellState} of the planned cells
+        :param template: fingerprint of the template
+        :param create: planned creates
+        :param update: planned updates
+        :param delete: planned deletes
+        """
+        changed = {parse_dn(dn).cell for dn in list(create) + list(update) + list(delete)}
+        now = time.time()
+        rows = []
+        for dn, state in cell_states.items():
+            dn_cell = state.dn_cell
+            if dn_cell in changed:
+                continue
+            rows.append((dn_cell, template, self._bcch(state.bcch), now))
+        with self._lock, self.connection:
+            self.connection.executemany("DELETE FROM cell_snapshot WHERE dn = ?", [(dn,) for dn in changed])
+            # column names are listed, files of older versions have additional columns
+            self.connection.executemany("INSERT OR REPLACE INTO cell_snapshot (dn, template, bcch, updated) "
+                                        "VALUES (?, ?, ?, ?)", rows)
+        print("Snapshot: {} cells stored, {} cells with changes removed".format(len(rows), len(changed)))
+
+    def close(self):
+        self.connection.close()
+
+
+class FailureBackoff(object):
+    """
+    SQLite store of push and verification outcomes per dn.
+    A dn that failed backoff_after_failures times in a row is not planned again until its
+    backoff expires; the backoff doubles with every further failure, up to max_hours.
+    A successful verification removes the dn from the store.
+    """
+
+    HELD = "failure backoff"
+
+    def __init__(self, path, after_failures=2, base_hours=6, max_hours=168):
+        """
+        :param path: path of the SQLite file
+        :param after_failures: number of failures in a row before the dn is held back
+        :param base_hours: first backoff
+        :param max_hours: maximum backoff
+        """
+        self.path = path
+        self.after_failures = max(1, after_failures)
+        self.base = base_hours * 3600
+        self.max = max_hours * 3600
+        import sqlite3
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS dn_outcome ("
+                                "dn TEXT PRIMARY KEY, failures INTEGER, last_error TEXT, retry_after REAL, updated REAL)")
+        self.connection.commit()
+
+    def blocked(self, list_dn):
+        """
+        :param list_dn: dn of planned changes
+        :return: {dn: (failures, last_error, retry_after)} for the dns in backoff
+        """
+        now = time.time()
+        blocked = {}
+        with self._lock:
+            for part in chunked(list_dn, SnapshotStore.SELECT_SIZE):
+                query = ("SELECT dn, failures, last_error, retry_after FROM dn_outcome "
+                         "WHERE retry_after > ? AND dn IN ({})".format(",".join("?" * len(part))))
+                for dn, failures, last_error, retry_after in self.connection.execute(query, [now] + part):
+                    blocked[dn] = (failures, last_error, retry_after)
+        return blocked
+
+    def hold(self, create, update, delete):
+        """
+        :return: create, update, delete without the dns in backoff and {dn: (failures, last_error, retry_after)} of them
+        """
+        held = self.blocked(list(create) + list(update) + list(delete))
+        if not held:
+            return create, update, delete, held
+        return ({dn: params for dn, params in create.items() if dn not in held},
+                {dn: params for dn, params in update.items() if dn not in held},
+                [dn for dn in delete if dn not in held],
+                held)
+
+    def record(self, outcomes):
+        """
+        :param outcomes: {dn: error} for dns that failed on their own, {dn: None} for verified dns
+        """
+        now = time.time()
+        with self._lock:
+            stored = {}
+            for part in chunked(list(outcomes), SnapshotStore.SELECT_SIZE):
+                query = "SELECT dn, failures FROM dn_outcome WHERE dn IN ({})".format(",".join("?" * len(part)))
+                stored.update(self.connection.execute(query, part))
+            rows = []
+            for dn, error in outcomes.items():
+                if error is None:
+                    continue
+                failures = stored.get(dn, 0) + 1
+                retry_after = 0.0
+                if failures >= self.after_failures:
+                    retry_after = now + min(self.max, self.base * 2 ** (failures - self.after_failures))
+                rows.append((dn, failures, str(error), retry_after, now))
+            with self.connection:
+                self.connection.executemany("DELETE FROM dn_outcome WHERE dn = ?",
+                                            [(dn,) for dn, error in outcomes.items() if error is None])
+                self.connection.executemany("INSERT OR REPLACE INTO dn_outcome VALUES (?, ?, ?, ?, ?)", rows)
+        print("Failure backoff: {} failed, {} verified".format(
+            len(rows), sum(1 for error in outcomes.values() if error is None)))
+
+    @staticmethod
+    def check_outcomes(check_results, outcomes):
+        """
+        Passes the results of CheckingChanges.iter_check_create_and_update through and collects their outcome
+        :param outcomes: dict filled with {dn: error or None}
+        """
+        for dn, same, different, not_create in check_results:
+            if not_create:
+                outcomes[dn] = "does not exist"
+            elif different:
+                outcomes[dn] = "differs: " + ", ".join(sorted(different))
+            else:
+                outcomes[dn] = None
+            yield dn, same, different, not_create
+
+    @staticmethod
+    def report_rows(held):
+        """
+        :return: rows of the Backoff sheet
+        """
+        for dn, (failures, last_error, retry_after) in sorted(held.items()):
+            yield [dn, failures, last_error, time.strftime("%d-%m-%Y %H:%M:%S", time.localtime(retry_after))]
+
+    def close(self):
+        self.connection.close()
+
+
+class ChangePlan(object):
+    """
+    Create/update/delete plan saved to a gzip json file, so that a reviewed Open Loop plan
+    can be pushed later without reading and planning the whole network again.
+    Together with the plan the fingerprint of every affected LNHOG is saved, and for the planned
+    creates and updates the fingerprint of the inputs of their cell: BCCH of the GSM neighbors
+    and LNCEL_FDD/LNCEL_TDD carrier. Before the push only the affected LNHOG and cells are read
+    again, and the objects changed since planning or planned from changed inputs are not pushed.
+    """
+
+    VERSION = 1
+    STALE = "stale plan"
+
+    def __init__(self, create, update, delete, fingerprints, template="", region="", created=0.0, inputs=None):
+        """
+        :param create: planned creates
+        :param update: planned updates
+        :param delete: planned deletes
+        :param fingerprints: {dn: fingerprint of the LNHOG at planning time, None if it did not exist}
+        :param template: fingerprint of the template
+        :param region: region name
+        :param created: time of planning
+        :param inputs: {dn: fingerprint of the inputs of the cell} of creates and updates (input_fingerprints),
+            empty for plans saved without them
+        """
+        self.create = create
+        self.update = update
+        self.delete = delete
+        self.fingerprints = fingerprints
+        self.template = template
+        self.region = region
+        self.created = created
+        self.inputs = inputs or {}
+
+    @staticmethod
+    def fingerprint(value_lnhog, diff_engine=None):
+        """
+        :param value_lnhog: LNHOG attributes from EMS, None if the object does not exist
+        :return: fingerprint of the attributes in canonical form, attributes without value are skipped,
+            None if the object does not exist
+        """
+        if value_lnhog is None:
+            return None
+        diff_engine = diff_engine or DiffEngine()
+        return SnapshotStore.fingerprint({param: diff_engine.normalize(param, value)
+                                          for param, value in value_lnhog.items() if value is not None})
+
+    @staticmethod
+    def input_fingerprints(cell_states, list_dn):
+        """
+        :param cell_states: {dn_lnhog: CellState}
+        :param list_dn: dn of LNHOG-0, e.g. of the planned creates and updates
+        :return: {dn: fingerprint of the BCCH and the carrier of the cell} of the dns found in cell_states
+        """
+        fingerprints = {}
+        for dn in list_dn:
+            state = cell_states.get(dn)
+            if state is not None:
+                carrier = {param: value for param, value in (state.carrier or {}).items() if value is not None}
+                fingerprints[dn] = SnapshotStore.fingerprint([SnapshotStore._bcch(state.bcch), carrier])
+        return fingerprints
+
+    @property
+    def dns(self):
+        return list(self.create) + list(self.update) + list(self.delete)
+
+    @classmethod
+    def build(cls, create, update, delete, current_values, template, region, inputs=None):
+        """
+        :param current_values: LNHOG attributes read from EMS for planning, keyed by LNHOG dn
+        :param inputs: input_fingerprints of the creates and updates at planning time
+        """
+        diff_engine = DiffEngine()
+        fingerprints = {dn: cls.fingerprint(current_values.get(dn), diff_engine)
+                        for dn in list(create) + list(update) + list(delete)}
+        return cls(create, update, delete, fingerprints, template, region, time.time(), inputs)
+
+    def save(self, path):
+        data = {"version": self.VERSION, "region": self.region, "template": self.template, "created": self.created,
+                "create": self.create, "update": self.update, "delete": self.delete,
+                "fingerprints": self.fingerprints, "inputs": self.inputs}
+        with gzip.open(path, "wt", encoding="utf-8") as plan_file:
+            json.dump(data, plan_file, separators=(",", ":"), default=str)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rt", encoding="utf-8") as plan_file:
+            data = json.load(plan_file)
+        if data.get("version") != cls.VERSION:
+            raise ValueError("Unsupported plan version {}".format(data.get("version")))
+        return cls(data["create"], data["update"], data["delete"], data["fingerprints"],
+                   data.get("template", ""), data.get("region", ""), data.get("created", 0.0), data.get("inputs"))
+
+    def input_cells(self, cells):
+        """
+        :param cells: target cells
+        :return: the target cells of the creates and updates with saved inputs
+        """
+        wanted = {parse_dn(dn).cell for dn in self.inputs}
+        return [cell for cell in cells if cell.dn in wanted]
+
+    def stale(self, current_values, template, max_age, current_inputs=None):
+        """
+        :param current_values: attributes of the affected LNHOG read from EMS now
+        :param template: fingerprint of the current template
+        :param max_age: maximum age of the plan in seconds
+        :param current_inputs: input_fingerprints of the cells of input_cells read now
+        :return: {dn: reason} for the objects that must not be pushed
+        """
+        if template != self.template:
+            return {dn: self.STALE + ": template changed" for dn in self.dns}
+        if time.time() - self.created > max_age:
+            return {dn: self.STALE + ": plan expired" for dn in self.dns}
+        diff_engine = DiffEngine()
+        stale = {dn: self.STALE + ": object changed" for dn in self.dns
+                 if self.fingerprint(current_values.get(dn), diff_engine) != self.fingerprints.get(dn)}
+        current_inputs = current_inputs or {}
+        for dn, fingerprint in self.inputs.items():
+            if dn not in stale and current_inputs.get(dn) != fingerprint:
+                stale[dn] = self.STALE + ": neighbors or carrier changed"
+        return stale
+
+
+class ChangeBudget(object):
+    """
+    Selects the changes to push in budgeted push_mode when the plan reaches Max_num_changes_to_push.
+    Changes are taken by priority of their kind, the rest is deferred: it is planned again
+    in the next run, so a large backlog is pushed over several runs.
+    """
+
+    DEFERRED = "deferred to next run"
+    KINDS = ("create", "arfcn", "threshold", "params", "delete")
+
+    def __init__(self, budget, priority=KINDS):
+        """
+        :param budget: maximum number of objects to push
+        :param priority: kinds of changes from the most important, kinds not listed go last
+        """
+        self.budget = budget
+        self.rank = {kind: position for position, kind in enumerate(priority)}
+
+    @staticmethod
+    def update_kind(params):
+        """
+        :param params: parameters of an update
+        :return: kind of the update
+        """
+        if "arfcnValueListGERAN" in params:
+            return "arfcn"
+        if any(param in params for param in BandResolver.THRESHOLD_PARAMS):
+            return "threshold"
+        return "params"
+
+    def select(self, create, update, delete):
+        """
+        :return: create, update, delete to push in this run and {dn: DEFERRED} for the rest
+        """
+        items = [("create", dn) for dn in create]
+        items += [(self.update_kind(params), dn) for dn, params in update.items()]
+        items += [("delete", dn) for dn in delete]
+        items.sort(key=lambda item: (self.rank.get(item[0], len(self.rank)), item[1]))
+
+        selected = {dn for _, dn in items[:self.budget]}
+        deferred = {dn: self.DEFERRED for _, dn in items[self.budget:]}
+        return ({dn: params for dn, params in create.items() if dn in selected},
+                {dn: params for dn, params in update.items() if dn in selected},
+                [dn for dn in delete if dn in selected],
+                deferred)
+
+
+class PushScheduler(object):
+    """
+    Sends the plan to OSS in batches of batch_size objects, at most max_workers batches at a time.
+    Creates, updates and deletes of one MRBTS go in the same batch, so every MRBTS is provisioned
+    by one plan activation per run (only an MRBTS with more than batch_size changes takes several).
+    A failed batch is split in two halves which are sent again, until the failing dn is isolated.
+    The halves are cut between two MRBTS where possible.
+    A single failing dn is sent again up to retries times.
+    If every batch of the first wave (max_workers batches) fails, two single objects of different
+    batches are sent as probes. If the probes fail too, OSS itself is failing (down, timeouts):
+    the push is stopped instead of sending every dn on its own. The objects of the failed batches
+    get STOPPED with the error, the objects that were not sent get NOT_PUSHED.
+    """
+
+    STOPPED = "push stopped"
+    NOT_PUSHED = "not pushed: push stopped"
+    # the return contract of push_ems_attributes_by_oss is not documented, any success is accepted
+    # except False and a status/result/state or a text that reports a failure
+    FAILED_RESULT = re.compile(r"fail|error|reject|abort", re.IGNORECASE)
+
+    def __init__(self, ems_client, region_name, batch_size, max_workers, retries):
+        self.ems_client = ems_client
+        self.region_name = region_name
+        self.batch_size = batch_size
+        self.max_workers = max(1, max_workers)
+        self.retries = max(0, retries)
+
+    @classmethod
+    def isolated_failure(cls, result):
+        """
+        :param result: push result of a dn
+        :return: True if the push of this dn failed on its own, not because the push was stopped
+        """
+        return result != "OK" and not result.startswith(cls.STOPPED) and not result.startswith(cls.NOT_PUSHED)
+
+    @staticmethod
+    def plan_items(creat, update, delete):
+        """
+        :return: list of (operation, dn, params), operation is "create", "update" or "delete"
+        """
+        return ([("create", dn, params) for dn, params in creat.items()] +
+                [("update", dn, params) for dn, params in update.items()] +
+                [("delete", dn, None) for dn in delete])
+
+    def plan_batches(self, creat, update, delete):
+        """
+        :return: list of batches, a batch is a list of plan_items with all changes of its MRBTS
+        """
+        return chunked_by_mrbts(self.plan_items(creat, update, delete), self.batch_size, dn_of=lambda item: item[1])
+
+    @staticmethod
+    def split(batch):
+        """
+        :return: two halves of the batch, cut at the MRBTS boundary nearest to the middle
+        """
+        middle = len(batch) // 2
+        boundaries = [position for position in range(1, len(batch))
+                      if parse_dn(batch[position][1]).mrbts_dn != parse_dn(batch[position - 1][1]).mrbts_dn]
+        if boundaries:
+            middle = min(boundaries, key=lambda position: abs(position - len(batch) / 2))
+        return batch[:middle], batch[middle:]
+
+    @classmethod
+    def result_error(cls, result_push):
+        """
+        :param result_push: return value of push_ems_attributes_by_oss
+        :return: error text if the value reports a failure, otherwise None
+        """
+        if result_push is False:
+            return "push returned False"
+        status = result_push
+        if isinstance(result_push, dict):
+            status = next((result_push[key] for key in ("status", "result", "state") if key in result_push), None)
+        if isinstance(status, str) and cls.FAILED_RESULT.search(status):
+            return str(result_push)
+        return None
+
+    def _push(self, batch):
+        creates = {dn: params for operation, dn, params in batch if operation == "create"}
+        updates = {dn: params for operation, dn, params in batch if operation == "update"}
+        deletes = [dn for operation, dn, params in batch if operation == "delete"]
+        start = time.time()
+        try:
+            result_push = self.ems_client.push_ems_attributes_by_oss(self.region_name, updates=updates,
+                                                                     creates=creates, deletes=deletes)
+            error = self.result_error(result_push)
+        except Exception as e:
+            result_push = None
+            error = str(e) or e.__class__.__name__
+        print("Push batch of {} objects (create {}, update {}, delete {}): {:.1f} s, result = {}".format(
+            len(batch), len(creates), len(updates), len(deletes), time.time() - start, error or result_push))
+        return error
+
+    def _after_push(self, batch, attempt, error, pending, result):
+        if error is None:
+            result.update((dn, "OK") for _, dn, _ in batch)
+        elif len(batch) > 1:
+            pending.extend((half, 0) for half in self.split(batch))
+        elif attempt < self.retries:
+            pending.append((batch, attempt + 1))
+        else:
+            result[batch[0][1]] = error
+
+    def run(self, creat, update, delete):
+        """
+        :return: dict {dn: "OK", error of the last attempt, STOPPED with the error or NOT_PUSHED}
+        """
+        result = {}
+        batches = self.plan_batches(creat, update, delete)
+        print("Push plan: {} MRBTS in {} batches".format(
+            len({parse_dn(dn).mrbts_dn for batch in batches for _, dn, _ in batch}), len(batches)))
+        wave, rest = batches[:self.max_workers], batches[self.max_workers:]
+        pending = [(batch, 0) for batch in rest]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            errors = list(executor.map(self._push, wave))
+            failed = [(batch, error) for batch, error in zip(wave, errors) if error is not None]
+            probes = []
+            if wave and len(failed) == len(wave):
+                probes = [[wave[0][0]], [wave[-1][-1]]] if wave[0][0] is not wave[-1][-1] else []
+            probe_errors = list(executor.map(self._push, probes))
+            if probes and all(error is not None for error in probe_errors):
+                print("The first {} batches and {} probes failed, push stopped: {}".format(
+                    len(wave), len(probes), probe_errors[0]))
+                for batch, error in failed:
+                    result.update((dn, "{}: {}".format(self.STOPPED, error)) for _, dn, _ in batch)
+                result.update((dn, self.NOT_PUSHED) for batch in rest for _, dn, _ in batch)
+                return result
+            probed = set()
+            for probe, error in zip(probes, probe_errors):
+                probed.add(probe[0][1])
+                self._after_push(probe, 0, error, pending, result)
+            for batch, error in failed:
+                batch = [item for item in batch if item[1] not in probed]
+                if batch:
+                    self._after_push(batch, 0, error, pending, result)
+            for batch, error in zip(wave, errors):
+                if error is None:
+                    self._after_push(batch, 0, error, pending, result)
+
+            while pending:
+                futures = [(batch, attempt, executor.submit(self._push, batch)) for batch, attempt in pending]
+                pending = []
+                for batch, attempt, future in futures:
+                    self._after_push(batch, attempt, future.result(), pending, result)
+        return result
+
+
+class Pipeline(object):
+    """
+    Runs items through stages, every stage in its own thread.
+    Stages are connected by queues of queue_size items, so a fast stage waits for the slow one
+    instead of holding the whole region in memory. The first error stops all stages and is raised by run().
+    """
+
+    _DONE = object()
+
+    def __init__(self, stages, queue_size=2):
+        """
+        :param stages: list of functions, each takes the result of the previous stage
+        :param queue_size: maximum number of items waiting between two stages
+        """
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.errors = []
+        self.busy = [0.0] * len(stages)
+        self._stop = threading.Event()
+
+    def _put(self, target, item):
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return self._DONE
+
+    def _run_stage(self, position, source, target):
+        stage = self.stages[position]
+        try:
+            while True:
+                item = self._get(source)
+                if item is self._DONE:
+                    break
+                start = time.time()
+                result = stage(item)
+                self.busy[position] += time.time() - start
+                if target is not None and not self._put(target, result):
+                    break
+        except Exception as e:
+            self.errors.append(e)
+            self._stop.set()
+        finally:
+            if target is not None:
+                self._put(target, self._DONE)
+
+    def run(self, items):
+        """
+        :param items: inputs of the first stage
+        """
+        source = queue.Queue()
+        for item in items:
+            source.put(item)
+        source.put(self._DONE)
+        queues = [source] + [queue.Queue(maxsize=self.queue_size) for _ in self.stages[1:]] + [None]
+        threads = [threading.Thread(target=self._run_stage, args=(position, queues[position], queues[position + 1]))
+                   for position in range(len(self.stages))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+class StreamingRun(object):
+    """
+    pipeline_mode of ScriptMain: chunks of target cells are read and planned in a Pipeline,
+    so while chunk N is planned, chunk N+1 is read.
+    Nothing is pushed here: the plans of all chunks are collected, so Max_num_changes_to_push,
+    push_mode and push_priority apply to the whole plan as in the normal run, followed by
+    one verification and one report.
+    """
+
+    def __init__(self, ems_reader, planner, bcch_cache, topology_workers, snapshot_store=None,
+                 template_fingerprint="", failure_backoff=None):
+        """
+        :param ems_reader: EmsReader
+        :param planner: LnhogPlanner
+        :param bcch_cache: BcchCache shared by all chunks
+        :param topology_workers: threads of TopologyIndex
+        :param snapshot_store: SnapshotStore of incremental_mode
+        :param template_fingerprint: fingerprint of the template for snapshot_store
+        :param failure_backoff: FailureBackoff, changes of the dns in backoff are not planned
+        """
+        self.ems_reader = ems_reader
+        self.planner = planner
+        self.bcch_cache = bcch_cache
+        self.topology_workers = topology_workers
+        self.snapshot_store = snapshot_store
+        self.template_fingerprint = template_fingerprint
+        self.failure_backoff = failure_backoff
+        self.held = {}
+        self.create = {}
+        self.update = {}
+        self.delete = []
+        self.current_values = {}
+        self.inputs = {}
+        self.planned_cells = 0
+        self.busy = {}
+
+    def read_chunk(self, cells):
+        topology = TopologyIndex.load(cells, self.ems_reader.amount_in_request, self.topology_workers, self.bcch_cache)
+        list_dn_cell, dict_dn_cell_bcch = LnhogPlanner.collect_bcch(topology)
+        if self.snapshot_store:
+            list_dn_cell = self.snapshot_store.changed_cells(list_dn_cell, dict_dn_cell_bcch, self.template_fingerprint)
+        dict_ems = self.ems_reader.get_child_attributes(list_dn_cell, dict(CARRIER_ATTRIBUTES, LNHOG=LNHOG_ATTRIBUTES))
+        return CellState.build(list_dn_cell, dict_dn_cell_bcch, dict_ems)
+
+    def plan_chunk(self, cell_states):
+        create, update, delete = self.planner.plan(cell_states)
+        if self.snapshot_store:
+            self.snapshot_store.save(cell_states, self.template_fingerprint, create, update, delete)
+        if self.failure_backoff:
+            create, update, delete, held = self.failure_backoff.hold(create, update, delete)
+            self.held.update(held)
+        self.current_values.update(CellState.current_values(cell_states, list(create) + list(update) + list(delete)))
+        self.inputs.update(ChangePlan.input_fingerprints(cell_states, list(create) + list(update)))
+        self.planned_cells += len(cell_states)
+        self.create.update(create)
+        self.update.update(update)
+        self.delete.extend(delete)
+        print("Chunk of {} cells: create {}, update {}, delete {}".format(
+            len(cell_states), len(create), len(update), len(delete)))
+
+    def run(self, chunks, queue_size=2):
+        """
+        :param chunks: lists of target cells, cells of one MRBTS in one chunk (chunked_by_mrbts)
+        :param queue_size: maximum number of chunks waiting between two stages
+        """
+        pipeline = Pipeline([self.read_chunk, self.plan_chunk], queue_size)
+        pipeline.run(chunks)
+        self.busy = dict(zip(("read", "plan"), (round(busy, 3) for busy in pipeline.busy)))
+        print("Pipeline busy time: {}".format(self.busy))
 
 
 def ScriptMain(script_data, _):
+    try:
+        _script_main(script_data)
+    finally:
+        # parsed dns are cached for one run only, the framework keeps the module loaded
+        clear_dn_caches()
+
+
+def _script_main(script_data):
     print("!!start!!")
     start_time = time.strftime("%d-%m-%Y %H:%M:%S")
     time_stamp_start = time.strftime("%d_%m_%Y_%H-%M-%S")
     print(start_time)
 
+    metrics = RunMetrics()
     cells = script_data.GetTargets()
-    ems_client = EMSHandler(script_data)
+    from enetsdk.Framework.cm_handler import EMSHandler
+    ems_client = metrics.wrap(EMSHandler(script_data))
+    ems_service = metrics.wrap(script_data.GetEmsService())
     SON_MODE = script_data.GetParameters()['SON Operation Mode']
     config_ini = MyModuleConfig(script_data)
     maximum_changes = config_ini.Max_num_changes
     email_str_alarm = config_ini.Email_Alarm
     oss_value_ini = config_ini.OSS_value
     dns_per_pull_ini = config_ini.amount_in_request
+    verbose = config_ini.verbose
     region_name = script_data.GetRegionName()
     module_name = script_data.GetModuleName()
     config_report = Report_Config(script_data)
     config_data = script_data.GetConfig("Custom_Configuration")
     pathout = script_data.GetUserOutputFilesLoc()
     outputfile = pathout + module_name + "_" + region_name + "_" + config_report.Report_prefix + "_" + time_stamp_start + ".xlsx"
-    reporter = ExcelWrapper(outputfile)
     email_str = config_report.emails
 
     all_cells = len(cells)
-    create = {}
-    update = {}
-    delete = []
+    metrics.set("target_cells", all_cells)
 
     print("*************************************************************************")
     print("Settings from ini file:")
@@ -316,6 +2225,13 @@ def ScriptMain(script_data, _):
     print("Address for Email_Alarm_changes: {} ".format(email_str_alarm))
     print("Read from OSS: {}".format(oss_value_ini))
     print("Number of query: {}".format(dns_per_pull_ini))
+    print("Read workers: {}".format(config_ini.read_workers))
+    print("Topology workers: {}".format(config_ini.topology_workers))
+    print("Audit Type: {}".format(config_report.audit_type))
+    print("Check SW: {} {}".format(config_ini.check_sw, config_ini.sw_version if config_ini.check_sw else ""))
+    print("Incremental mode: {}".format(config_ini.incremental_mode))
+    print("Pipeline mode: {}".format(config_ini.pipeline_mode))
+    print("Report format: {}".format(config_ini.report_format))
     print("*************************************************************************")
 
     if config_data and isinstance(config_data, dict):
@@ -324,235 +2240,308 @@ def ScriptMain(script_data, _):
     else:
         print("No active configuration file found. Stop")
         exit()
-    wb = openpyxl.load_workbook(io_stream or filename)
-    default_param = parser_exel(wb)
-    str_v_dict_1 = default_param.get("b2Threshold1GERANQci1")
-    b2Threshold1GERANQci1_dict = json.loads(str_v_dict_1)
-    str_v_dict_2 = default_param.get("b2Threshold1GERAN")
-    b2Threshold1GERAN_dict = json.loads(str_v_dict_2)
-    default_param['b2Threshold1GERANQci1'] = b2Threshold1GERANQci1_dict
-    default_param['b2Threshold1GERAN'] = b2Threshold1GERAN_dict
-
-    list_dn_cell = []
-    dict_dn_cell_list_bcch = {}
-    for cell in cells:
-        dn_cell = cell.dn
-        list_dn_cell.append(dn_cell)
-        # sosedi
-        iratNeighbors = cell.GetNeighbors(neighborType="irat", ignore_missing_data=True)
-        gsm_neighbors = []
-        for neighbor in iratNeighbors:
-            list_bcchNo_neib = []
-            if neighbor.technology == "GSM":
-                gsm_neighbors.append(neighbor)
-            for gsm_neib in gsm_neighbors:
-                bcchNo_neib = gsm_neib.bcch_frequency
-                list_bcchNo_neib.append(str(bcchNo_neib))
-                list_bcchNo_neib = list(set(list_bcchNo_neib))
-                dict_dn_cell_list_bcch[dn_cell+"/LNHOG-0"] = list_bcchNo_neib
-
-    dict_lnhog_param = ems_client.get_child_attributes(list_dn_cell, "LNHOG",
-                                                       {"LNHOG": ["arfcnValueListGERAN", "bandIndicatorGERAN", "reportIntervalGERAN",
-                                                                  "nccperm", "hysB2ThresholdGERAN", "b2Threshold2RssiGERAN",
-                                                                  "b2TimeToTriggerGERANMeas",
-                                                                  "b2Threshold1GERANQci1", "b2Threshold1GERAN", "b2Threshold2RssiGERANQci1"]},
-                                                       return_by_dn=False)
-
-    dict_get_ems_atribut_FDD = ems_client.get_child_attributes(list_dn_cell, "LNCEL_FDD", {"LNCEL_FDD": ["earfcnDL", "dlChBw"]}, return_by_dn=False)
-    dict_get_ems_atribut_TDD = ems_client.get_child_attributes(list_dn_cell, "LNCEL_TDD", {"LNCEL_TDD": ["earfcn", "chBw"]}, return_by_dn=False)
-    dict_get_ems_atribut_FDD_TDD = {**dict_get_ems_atribut_FDD, **dict_get_ems_atribut_TDD}
-    dict_get_ems_atribut_FDD_TDD_new = {}
-    for dn_cel_FDD_TDD, value_FDD_TDD in dict_get_ems_atribut_FDD_TDD.items():
-        split_dn_cell = dn_cel_FDD_TDD.split("/", 4)
-        dn_cell_LNHOG_FDD_TDD = split_dn_cell[0] + "/" + split_dn_cell[1] + "/" + split_dn_cell[2] + "/" + split_dn_cell[3] + "/LNHOG-0"
-        dict_get_ems_atribut_FDD_TDD_new[dn_cell_LNHOG_FDD_TDD] = value_FDD_TDD
-
-    all_dn_lnhog_current = []
-    for dn_lnhog_current in dict_lnhog_param.keys():
-        all_dn_lnhog_current.append(dn_lnhog_current)
-
-
-    # update
-    # for dn, value in dict_dn_cell_list_bcch.items():
-    #     slovar = {}
-    #     value_lnhog = dict_lnhog_param.get(dn, {})
-    #     for key_1, value_1 in value_lnhog.items():
-    #         if sorted(value_1) !=  sorted(value):
-    #             slovar['arfcnValueListGERAN'] = value
-    #             update[dn] = slovar
-    # print("update", update)
-
-    dict_get_ems_atribut_FDD_TDD_new
-
-    for dn, value in dict_dn_cell_list_bcch.items():
-        update1 = {}
-        slovar = {}
-        nccperm_255 = {}
-        b2Threshold1GERAN_m120 = {}
-        b2Threshold1GERANQci1_m120 = {}
-        value_lnhog = dict_lnhog_param.get(dn, {})
-        for key_1, value_1 in value_lnhog.items():
-            if key_1 == "b2Threshold1GERANQci1" and value_1 != str(default_param.get("b2Threshold1GERANQci1").get(band_bw(dn, dict_get_ems_atribut_FDD_TDD_new), -120)):
-                b2Threshold1GERANQci1_m120[key_1] = str(default_param.get("b2Threshold1GERANQci1").get(band_bw(dn, dict_get_ems_atribut_FDD_TDD_new), -120))
-            elif key_1 == "b2Threshold1GERAN" and value_1 != str(default_param.get("b2Threshold1GERAN").get(band_bw(dn, dict_get_ems_atribut_FDD_TDD_new), -120)):
-                b2Threshold1GERAN_m120[key_1] = str(default_param.get("b2Threshold1GERAN").get(band_bw(dn, dict_get_ems_atribut_FDD_TDD_new), -120))
-            elif key_1 == "arfcnValueListGERAN" and collections.Counter(value_1) != collections.Counter(value):
-                slovar['arfcnValueListGERAN'] = value
-            elif key_1 != "b2Threshold1GERANQci1" and key_1 != "b2Threshold1GERAN" and key_1 != "arfcnValueListGERAN" and value_1 != str(
-                    default_param.get(key_1)):
-                nccperm_255[key_1] = str(default_param.get(key_1))
-
-            update1.update(slovar)
-            update1.update(nccperm_255)
-            update1.update(b2Threshold1GERAN_m120)
-            update1.update(b2Threshold1GERANQci1_m120)
-            if update1:
-                update[dn] = update1
-    print("update", update)
-
-    dn_chahnge = dict_dn_cell_list_bcch.keys() - all_dn_lnhog_current
-    list_dn_chahnge = list(dn_chahnge)
-    for a in list_dn_chahnge:
-        default_param_create = {}
-        dict_valeu_def_param_change = {}
-        for key_2param, value_2param in default_param.items():
-            if key_2param == "b2Threshold1GERANQci1":
-                dict_valeu_def_param_change[key_2param] = value_2param.get(band_bw(a, dict_get_ems_atribut_FDD_TDD_new), -120)
-            if key_2param == "b2Threshold1GERAN":
-                dict_valeu_def_param_change[key_2param] = value_2param.get(band_bw(a, dict_get_ems_atribut_FDD_TDD_new), -120)
-        arfcnValueListGERAN = {}
-        arfcnValueListGERAN["arfcnValueListGERAN"] = dict_dn_cell_list_bcch.get(a, dict_get_ems_atribut_FDD_TDD_new)
-        default_param_create.update(default_param)
-        default_param_create.update(arfcnValueListGERAN)
-        default_param_create.update(dict_valeu_def_param_change)
-        create[a] = default_param_create
-    print("creat_sp", create)
-
-        # delete
-    for y in all_dn_lnhog_current:
-        if y[-1] != "0":
-            delete.append(y)
-    print("delete", delete)
-
-
-    # PUSH
-    all_changes = len(create) + len(update) + len(delete)
-
+    with metrics.phase("template"):
+        template_cache_file = config_ini.template_cache_file or pathout + module_name + "_template_cache.json"
+        template = TemplateLoader(template_cache_file).load(io_stream, filename)
+        default_param = dict(template.params)
+        band_table = BandTable(template.extra_bands)
+
+    template_fingerprint = SnapshotStore.fingerprint([default_param, band_table.ranges])
+    apply_plan_file = config_report.apply_plan_file
+    stale = {}
     flag_alarm = 0
-    if int(all_changes) > 0:
-        print("{} differences found".format(int(all_changes)))
-        if SON_MODE == "Closed Loop":
-            print("Send changes to push")
-            if maximum_changes > int(all_changes):
-                try:
-                    send_to_net = pusher(ems_client, region_name, create, update, delete)
-                    print("Result push = ", send_to_net)
-                except Exception as e:
-                    print("Error in process push = ", e)
-            else:
-                flag_alarm = 1
-                print("The number of changes exceeds the threshold of {} changes".format(maximum_changes))
+    send_to_net = None
+    held = {}
+    failure_backoff = None
+    if config_ini.failure_backoff:
+        backoff_file = config_ini.backoff_file or pathout + module_name + "_" + region_name + "_backoff.sqlite"
+        failure_backoff = FailureBackoff(backoff_file, config_ini.backoff_after_failures,
+                                         config_ini.backoff_base_hours, config_ini.backoff_max_hours)
+    if apply_plan_file:
+        if not os.path.isabs(apply_plan_file):
+            apply_plan_file = os.path.join(pathout, apply_plan_file)
+        with metrics.phase("staleness_check"):
+            try:
+                plan = ChangePlan.load(apply_plan_file)
+            except Exception as e:
+                print("Plan file {} can not be read: {}. Stop".format(apply_plan_file, e))
+                exit()
+            if plan.region != region_name:
+                print("Plan file {} was built for region {}. Stop".format(apply_plan_file, plan.region))
+                exit()
+            create, update, delete = plan.create, plan.update, plan.delete
+            plan_reader = ReadSetData(script_data, dns_per_pull_ini, config_ini.read_workers, ems_service)
+            dict_lnhog_param = plan_reader.read_date({dn: LNHOG_ATTRIBUTES for dn in plan.dns})
+            current_inputs = {}
+            if plan.inputs:
+                # neighbors and carrier of the planned cells only, without the BCCH cache: it may be older than the plan
+                topology = TopologyIndex.load(plan.input_cells(cells), dns_per_pull_ini, config_ini.topology_workers)
+                list_dn_cell, dict_dn_cell_bcch = LnhogPlanner.collect_bcch(topology)
+                del topology
+                ems_reader = EmsReader(ems_client, dns_per_pull_ini, config_ini.read_workers)
+                dict_ems = ems_reader.get_child_attributes(list_dn_cell, CARRIER_ATTRIBUTES)
+                current_inputs = ChangePlan.input_fingerprints(
+                    CellState.build(list_dn_cell, dict_dn_cell_bcch, dict_ems), plan.inputs)
+            stale = plan.stale(dict_lnhog_param, template_fingerprint, config_ini.plan_max_age_hours * 3600,
+                               current_inputs)
+            print("Apply plan {}: {} objects, {} changed since planning".format(
+                apply_plan_file, len(plan.dns), len(stale)))
+        metrics.set("stale", len(stale))
+    else:
+        if config_ini.check_sw:
+            with metrics.phase("sw_version"):
+                sw_reader = ReadSetData(script_data, dns_per_pull_ini, config_ini.read_workers, ems_service)
+                cells = SwVersionFilter(sw_reader, config_ini.sw_version, config_ini.sw_attribute).supported(cells)
+            metrics.set("supported_sw_cells", len(cells))
+
+        if config_report.audit_type == "Unlocked cell only":
+            with metrics.phase("cell_state"):
+                state_reader = ReadSetData(script_data, dns_per_pull_ini, config_ini.read_workers, ems_service)
+                cells = AdminStateFilter(state_reader).unlocked(cells)
+            metrics.set("unlocked_cells", len(cells))
+
+        bcch_cache = BcchCache(config_ini.bcch_cache_file, config_ini.bcch_cache_ttl_hours * 3600)
+        snapshot_store = None
+        if config_ini.incremental_mode:
+            snapshot_file = config_ini.snapshot_file or pathout + module_name + "_" + region_name + "_snapshot.sqlite"
+            snapshot_store = SnapshotStore(snapshot_file, config_ini.snapshot_ttl_hours * 3600)
+        ems_reader = EmsReader(ems_client, dns_per_pull_ini, config_ini.read_workers)
+
+        pipeline_mode = config_ini.pipeline_mode
+        pipeline_chunk_cells = config_ini.pipeline_chunk_cells
+        if config_ini.memory_limit_mb > 0 and not pipeline_mode:
+            # chunk being read, chunks in the queue, chunk being planned
+            chunk_cells = chunk_cells_for_memory(config_ini.memory_limit_mb, len(cells),
+                                                 config_ini.pipeline_queue_size + 2)
+            if chunk_cells:
+                pipeline_mode = True
+                pipeline_chunk_cells = chunk_cells
+                print("{} cells do not fit into memory_limit_mb {}, processing in chunks of {} cells".format(
+                    len(cells), config_ini.memory_limit_mb, chunk_cells))
+                metrics.set("memory_fallback_chunk_cells", chunk_cells)
+
+        planner = LnhogPlanner(default_param, BandResolver(default_param, band_table=band_table))
+
+        if pipeline_mode:
+            with metrics.phase("pipeline"):
+                streaming = StreamingRun(ems_reader, planner, bcch_cache, config_ini.topology_workers,
+                                         snapshot_store, template_fingerprint, failure_backoff)
+                streaming.run(chunked_by_mrbts(cells, pipeline_chunk_cells, dn_of=lambda cell: cell.dn),
+                              config_ini.pipeline_queue_size)
+            create, update, delete = streaming.create, streaming.update, streaming.delete
+            dict_lnhog_param = streaming.current_values
+            plan_inputs = streaming.inputs
+            held = streaming.held
+            metrics.set("planned_cells", streaming.planned_cells)
+            for stage, busy in streaming.busy.items():
+                metrics.set("pipeline_" + stage + "_busy", busy)
+            del streaming
         else:
-            print("The module was launched in open loop")
+            with metrics.phase("neighbors"):
+                topology = TopologyIndex.load(cells, dns_per_pull_ini, config_ini.topology_workers, bcch_cache)
+                list_dn_cell, dict_dn_cell_bcch = LnhogPlanner.collect_bcch(topology)
+                del topology
+                if snapshot_store:
+                    list_dn_cell = snapshot_store.changed_cells(list_dn_cell, dict_dn_cell_bcch, template_fingerprint)
+                    print("Incremental mode: {} of {} cells to plan".format(len(list_dn_cell), len(cells)))
+            metrics.set("planned_cells", len(list_dn_cell))
+
+            with metrics.phase("ems_read"):
+                dict_ems = ems_reader.get_child_attributes(list_dn_cell, dict(CARRIER_ATTRIBUTES, LNHOG=LNHOG_ATTRIBUTES))
+                cell_states = CellState.build(list_dn_cell, dict_dn_cell_bcch, dict_ems)
+                del dict_ems, dict_dn_cell_bcch, list_dn_cell
+
+            with metrics.phase("plan"):
+                create, update, delete = planner.plan(cell_states)
+                if snapshot_store:
+                    snapshot_store.save(cell_states, template_fingerprint, create, update, delete)
+                if failure_backoff:
+                    create, update, delete, held = failure_backoff.hold(create, update, delete)
+                dict_lnhog_param = CellState.current_values(cell_states, list(create) + list(update) + list(delete))
+                plan_inputs = ChangePlan.input_fingerprints(cell_states, list(create) + list(update))
+                del cell_states
+
+        bcch_cache.save()
+        metrics.set("bcch_cache_hits", bcch_cache.hits)
+        metrics.set("bcch_cache_misses", bcch_cache.misses)
+        if snapshot_store:
+            snapshot_store.close()
+        if config_ini.plan_export:
+            plan_file = os.path.splitext(outputfile)[0] + "_plan.json.gz"
+            ChangePlan.build(create, update, delete, dict_lnhog_param, template_fingerprint, region_name,
+                             plan_inputs).save(plan_file)
+            print("Plan saved to {}".format(plan_file))
+    metrics.set("create", len(create))
+    metrics.set("update", len(update))
+    metrics.set("delete", len(delete))
+    if failure_backoff:
+        metrics.set("held", len(held))
+        print("Failure backoff: {} objects held back".format(len(held)))
+    if verbose:
+        print("update", update)
+        print("creat_sp", create)
+        print("delete", delete)
     else:
-        print("No changes to push")
+        print("Planned: create {}, update {}, delete {}".format(len(create), len(update), len(delete)))
 
-    # report
-    start_time = time.strftime("%d-%m-%Y_%H-%M-%S")
-    stopt_time = time.strftime("%d-%m-%Y_%H-%M-%S")
-    read_set_date = ReadSetData(script_data)
-    get_class = CheckingChanges()
-    rep = ReportGenerator(outputfile, start_time, stopt_time)
 
-    name_list = ["Create", "Update", "Delete"]
-
-    for i in name_list:
-        curr_list = rep.create_new_sheets(i, ["Object", "Parameter", "Value", "Result"])
+    # PUSH
+    push_create = {dn: params for dn, params in create.items() if dn not in stale}
+    push_update = {dn: params for dn, params in update.items() if dn not in stale}
+    push_delete = [dn for dn in delete if dn not in stale]
+    all_changes = len(push_create) + len(push_update) + len(push_delete)
+
+    with metrics.phase("push"):
+        if int(all_changes) > 0:
+            print("{} differences found".format(int(all_changes)))
+            if SON_MODE == "Closed Loop":
+                print("Send changes to push")
+                not_pushed = dict(stale)
+                if maximum_changes <= int(all_changes):
+                    flag_alarm = 1
+                    print("The number of changes exceeds the threshold of {} changes".format(maximum_changes))
+                    if config_ini.push_mode == "budgeted":
+                        # strict mode pushes only below the threshold, so at most maximum_changes - 1 in both modes
+                        budget = ChangeBudget(maximum_changes - 1, config_ini.push_priority)
+                        push_create, push_update, push_delete, deferred = budget.select(push_create, push_update, push_delete)
+                        print("Budgeted push: {} changes now, {} deferred to next run".format(
+                            int(all_changes) - len(deferred), len(deferred)))
+                        metrics.set("deferred", len(deferred))
+                        not_pushed.update(deferred)
+                if maximum_changes > int(all_changes) or config_ini.push_mode == "budgeted":
+                    try:
+                        send_to_net = pusher(ems_client, region_name, push_create, push_update, push_delete,
+                                             config_ini.push_batch_size, config_ini.push_workers, config_ini.push_retries)
+                        send_to_net.update(not_pushed)
+                    except Exception as e:
+                        print("Error in process push = ", e)
+            else:
+                print("The module was launched in open loop")
+        else:
+            print("No changes to push")
+            if stale and SON_MODE == "Closed Loop":
+                send_to_net = dict(stale)
+    if send_to_net is not None:
+        metrics.set("pushed_ok", sum(1 for result in send_to_net.values() if result == "OK"))
+        metrics.set("push_failed", sum(1 for result in send_to_net.values() if result != "OK" and
+                                       result != ChangeBudget.DEFERRED and not result.startswith(ChangePlan.STALE)))
+
+    # verification and report: every sheet is read back and written before the next one,
+    # so only the readback of one sheet is held in memory; the time goes to the verify and report phases
+    read_set_date = ReadSetData(script_data, dns_per_pull_ini, config_ini.read_workers, ems_service)
+    verify_mode = config_ini.verify_mode
+    verify_sample_size = config_ini.verify_sample_size
+
+    def verify(changes):
+        with metrics.phase("verify"):
+            return read_set_date.read_for_check(changes, send_to_net, dict_lnhog_param,
+                                                verify_mode, verify_sample_size)
+
+    with metrics.phase("report"):
+        start_time = time.strftime("%d-%m-%Y_%H-%M-%S")
+        stopt_time = time.strftime("%d-%m-%Y_%H-%M-%S")
+        get_class = CheckingChanges()
+        if config_ini.report_format in StreamingReportGenerator.FORMATS:
+            rep = StreamingReportGenerator(outputfile, start_time, stopt_time, config_ini.report_format)
+        else:
+            rep = ReportGenerator(outputfile, start_time, stopt_time)
 
+        name_list = ["Create", "Update", "Delete"]
 
+        for i in name_list:
+            curr_list = rep.create_new_sheets(i, ["Object", "Parameter", "Value", "Result"])
+        if failure_backoff:
+            curr_list = rep.create_new_sheets("Backoff", ["Object", "Failures", "Last error", "Retry after"])
+            curr_list.AddData(list(FailureBackoff.report_rows(held)))
 
+        # outcomes of the pushed objects for failure_backoff: only failures isolated to the dn
+        # (a single object failed after its retries) and the verification below; a stopped push
+        # says nothing about the dn and must not hold it back
+        outcomes = {}
+        if send_to_net is not None:
+            outcomes.update((dn, result) for dn, result in send_to_net.items() if
+                            PushScheduler.isolated_failure(result) and result != ChangeBudget.DEFERRED and
+                            not result.startswith(ChangePlan.STALE))
 
     if delete:
-        real_val_delete = read_set_date.read_date(delete)
-        delete_mo, not_delete_mo = get_class.check_delete(real_val_delete, delete)
+        real_val_delete, etalon_delete, unchecked_delete = verify(delete)
+        with metrics.phase("report"):
+            delete_mo, not_delete_mo = get_class.check_delete(real_val_delete, etalon_delete) if etalon_delete else ({}, {})
 
-        curr_list.UseSheet("Delete")
+            curr_list.UseSheet("Delete")
 
-        if delete_mo:
-            same_create_adapt = rep.data_transformation(delete_mo)
-            curr_list.AddData(same_create_adapt)
+            if unchecked_delete:
+                curr_list.AddData(rep.data_transformation(read_set_date.unchecked_rows(delete, unchecked_delete)))
 
-        if not_delete_mo:
-            diff_create_adapt = rep.data_transformation(not_delete_mo)
-            curr_list.AddData(diff_create_adapt)
+            if send_to_net is not None:
+                outcomes.update((dn, None) for dn in delete_mo)
+                outcomes.update((dn, "not deleted") for dn in not_delete_mo)
 
-    if create:
-        real_val_create = read_set_date.read_date(create)
-        same_create, diff_create, not_exist_create = get_class.check_create_and_update(real_val_create, create)
+            if delete_mo:
+                same_create_adapt = rep.data_transformation(delete_mo)
+                curr_list.AddData(same_create_adapt)
 
-        curr_list.UseSheet("Create")
+            if not_delete_mo:
+                diff_create_adapt = rep.data_transformation(not_delete_mo)
+                curr_list.AddData(diff_create_adapt)
+        del real_val_delete, etalon_delete
 
-        if same_create:
-            same_create_adapt = rep.data_transformation(same_create)
-            curr_list.AddData(same_create_adapt)
+    for name_sheet, changes in (("Create", create), ("Update", update)):
+        if not changes:
+            continue
+        real_val, etalon, unchecked = verify(changes)
+        with metrics.phase("report"):
 
-        if diff_create:
-            diff_create_adapt = rep.data_transformation(diff_create)
-            curr_list.AddData(diff_create_adapt)
+            curr_list.UseSheet(name_sheet)
 
-        if not_exist_create:
-            not_exist_create_adapt = rep.data_transformation(not_exist_create)
-            curr_list.AddData(not_exist_create_adapt)
+            if unchecked:
+                curr_list.AddData(rep.data_transformation(read_set_date.unchecked_rows(changes, unchecked)))
 
-    if update:
-        real_val_update = read_set_date.read_date(update)
-        same_update, diff_update, not_exist_update = get_class.check_create_and_update(real_val_update, update)
+            check_results = get_class.iter_check_create_and_update(real_val, etalon)
+            if send_to_net is not None:
+                check_results = FailureBackoff.check_outcomes(check_results, outcomes)
+            curr_list.AddData(rep.check_rows(check_results))
+        del real_val, etalon, check_results
 
-        curr_list.UseSheet("Update")
+    with metrics.phase("report"):
+        rep.saved_file()
 
-        if same_update:
-            same_create_adapt = rep.data_transformation(same_update)
-            curr_list.AddData(same_create_adapt)
-
-        if diff_update:
-            diff_create_adapt = rep.data_transformation(diff_update)
-            curr_list.AddData(diff_create_adapt)
-
-        if not_exist_update:
-            not_exist_create_adapt = rep.data_transformation(not_exist_update)
-            curr_list.AddData(not_exist_create_adapt)
-
-
-    rep.saved_file()
+        if failure_backoff:
+            failure_backoff.record(outcomes)
+            failure_backoff.close()
 
     # send email
+    with metrics.phase("email"):
+        if (email_str and email_str.strip()) or (email_str_alarm and email_str_alarm.strip()):
+            receivers = [r.strip() for r in re.split(';|,', email_str)]
+            receivers_alarm = [r.strip() for r in re.split(';|,', email_str_alarm)]
+            if receivers or receivers_alarm:
+                emailer = script_data.get_emailer()
+                if rep.files:
+                    attachments = rep.files
+                else:
+                    attachments = None
+                body = "*******THIS IS AN AUTO GENERATED EMAIL - PLEASE DO NOT REPLY********"
+                try:
+                    # emailer.SendMail(receivers,
+                    #                  region_name + ' ' + EMAIL_SUBJECT + module_name + ' ' + config_report.Report_prefix,
+                    #                  body, attachments=attachments)
+                    if flag_alarm == 1:
+                        emailer.SendMail(receivers_alarm, EMAIL_SUBJECT_ALARM + ' ' + region_name + ' all of changes: ' + str(all_changes) + ' module:' + module_name + ' ' + config_report.Report_prefix, body, attachments=attachments)
+                except Exception:
+                    print("Email Sending Failed")
+        else:
+            print("!" * 100)
+            print("No email address")
+            print("!" * 100)
 
-    if (email_str and email_str.strip()) or (email_str_alarm and email_str_alarm.strip()):
-        receivers = [r.strip() for r in re.split(';|,', email_str)]
-        receivers_alarm = [r.strip() for r in re.split(';|,', email_str_alarm)]
-        if receivers or receivers_alarm:
-            emailer = script_data.get_emailer()
-            if outputfile:
-                attachments = [outputfile]
-            else:
-                attachments = None
-            body = "*******THIS IS AN AUTO GENERATED EMAIL - PLEASE DO NOT REPLY********"
-            try:
-                # emailer.SendMail(receivers,
-                #                  region_name + ' ' + EMAIL_SUBJECT + module_name + ' ' + config_report.Report_prefix,
-                #                  body, attachments=attachments)
-                if flag_alarm == 1:
-                    emailer.SendMail(receivers_alarm, EMAIL_SUBJECT_ALARM + ' ' + region_name + ' all of changes: ' + str(all_changes) + ' module:' + module_name + ' ' + config_report.Report_prefix, body, attachments=attachments)
-            except Exception:
-                print("Email Sending Failed")
-    else:
-        print("!" * 100)
-        print("No email address")
-        print("!" * 100)
+    metrics_file = os.path.splitext(outputfile)[0] + "_metrics.json"
+    if metrics.save(metrics_file):
+        print("Run metrics: {}".format(metrics_file))
 
 
 
-def pusher(ems_client, region_name, creat, update, delete):
+def pusher(ems_client, region_name, creat, update, delete, batch_size=100, max_workers=2, retries=1):
 
     all_changes = len(creat) + len(update) + len(delete)
     print("{} differences found".format(all_changes))
@@ -561,40 +2550,43 @@ def pusher(ems_client, region_name, creat, update, delete):
     print("Number of delete = ", len(delete))
     print("Send changes to push")
 
-    result_push = ems_client.push_ems_attributes_by_oss(region_name, updates=update, creates=creat, deletes=delete)
-    print("result_push = ", result_push)
+    scheduler = PushScheduler(ems_client, region_name, batch_size, max_workers, retries)
+    result_push = scheduler.run(creat, update, delete)
+    failed = {dn: error for dn, error in result_push.items() if error != "OK"}
+    print("result_push = {} OK, {} failed".format(len(result_push) - len(failed), len(failed)))
+    stopped = 0
+    for dn, error in failed.items():
+        if PushScheduler.isolated_failure(error):
+            print("Push failed for {}: {}".format(dn, error))
+        else:
+            stopped += 1
+    if stopped:
+        print("{} objects not provisioned because the push was stopped".format(stopped))
 
     return result_push
 
 
 def parser_exel(wb):
-    name_sheets = wb.sheetnames
-    for current_sheets in name_sheets:
-        sheet = wb[current_sheets]
-        row_M = sheet.max_row
-        col_M = sheet.max_column
-        parser_table = []
+    slovar = {}
+    for sheet in wb.worksheets:
         slovar = {}
-        if col_M > 1 or row_M > 1:
-            for n in range(1, row_M + 1):
-                param = sheet.cell(row=n, column=1).value
-                for i in range(2, col_M + 1):
-                    val = sheet.cell(row=n, column=i).value
-                    parser_table.append(val)
-                    slovar[param] = val
+        for row in sheet.iter_rows(values_only=True):
+            if len(row) > 1:
+                slovar[row[0]] = row[-1]
     slovar.pop('Parametr')
     return slovar
 
-def band_bw(dn_lnhog_chek, dict_get_ems_atribut_FDD_TDD_new):
+def band_bw(dn_lnhog_chek, dict_get_ems_atribut_FDD_TDD_new, band_table=None):
     """
     :param dn_lnhog:
+    :param band_table: BandTable, built-in bands if not set
     :return: band_bandwidth e.c "LTE_1800_20"
     """
     value_param = dict_get_ems_atribut_FDD_TDD_new.get(dn_lnhog_chek)
     earfcn = value_param.get("earfcnDL")
     if earfcn ==  None:
         earfcn = value_param.get("earfcn")
-    band = def_band(int(earfcn))
+    band = (band_table or DEFAULT_BAND_TABLE).band(int(earfcn))
 
     chBw = value_param.get("dlChBw")
     if chBw == None:
@@ -611,26 +2603,10 @@ def def_band(channel):
     :param channel: cell_from_dn.earfcn
     :return: e.g. "LTE_1800"
     """
-    # print "check band"
-    if 9870 <= channel <= 9919:
-        band_f = "LTE_450"
-    elif 6150 <= channel <= 6449:
-        band_f = "LTE_800"
-    elif 1200 <= channel <= 1949:
-        band_f = "LTE_1800"
-    elif 2750 <= channel <= 3449:
-        band_f = "LTE_2600"
-    elif 0 <= channel <= 599:
-        band_f = "LTE_2100"
-    elif 38650 <= channel <= 39649:
-        band_f = "LTE_2300"
-    elif 38250 <= channel <= 38649:
-        band_f = "LTE_1900"
-    elif 46709 <= channel <= 54539:
-        band_f = "LTE_Unlicensed"
-    else:
-        band_f = "Unknown"
-    return band_f
+    return DEFAULT_BAND_TABLE.band(channel)
+
+
+DEFAULT_BAND_TABLE = BandTable()
 
 
 def GetConfigCategoryList():
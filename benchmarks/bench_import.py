@@ -0,0 +1,76 @@
+"""
+Benchmark of the Lnhog_change import.
+
+Eden-NET imports the module to read GetParameters, GetDesc, GetVersion and GetScopeRules
+without running ScriptMain. Every sample runs in a fresh interpreter with the stand-in
+enetsdk/enetconfig/tiermap modules of bench_lnhog_change, times the import and the metadata
+calls, and lists which heavy modules were loaded on the way.
+
+Usage:
+    python benchmarks/bench_import.py --repeat 20
+    python benchmarks/bench_import.py --module old/Lnhog_change.py
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+HEAVY = ["openpyxl", "multiprocessing", "concurrent.futures.process", "sqlite3", "enetsdk.Utility",
+         "enetsdk.Framework.cm_handler", "tiermap.tier_mapper"]
+
+SAMPLE = """
+import json, sys, time
+sys.path[:0] = [{here!r}, {module_dir!r}]
+from bench_lnhog_change import install_stand_ins
+install_stand_ins()
+before = set(sys.modules)
+start = time.perf_counter()
+import Lnhog_change as module
+imported = time.perf_counter()
+module.GetParameters(), module.GetDesc(), module.GetVersion(), module.GetScopeRules()
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "metadata": done - imported,
+                  "loaded": [name for name in {heavy!r} if name in sys.modules and name not in before]}}))
+"""
+
+
+def sample(module_dir):
+    code = SAMPLE.format(here=HERE, module_dir=module_dir, heavy=HEAVY)
+    # a deployed module is imported from __pycache__, so bytecode writing is left on
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    out = subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True, env=env)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10, help="number of fresh interpreters")
+    parser.add_argument("--module", default=os.path.join(ROOT, "Lnhog_change.py"), help="path to Lnhog_change.py")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    module_dir = os.path.dirname(os.path.abspath(args.module))
+    sample(module_dir)  # warm-up, writes the bytecode cache
+    samples = [sample(module_dir) for _ in range(args.repeat)]
+    result = {
+        "import_ms": statistics.median(s["import"] for s in samples) * 1000,
+        "metadata_ms": statistics.median(s["metadata"] for s in samples) * 1000,
+        "loaded": samples[-1]["loaded"],
+    }
+    print("{:>10} {:>12}  {}".format("import_ms", "metadata_ms", "heavy modules loaded"))
+    print("{import_ms:>10.1f} {metadata_ms:>12.3f}  {loaded}".format(
+        import_ms=result["import_ms"], metadata_ms=result["metadata_ms"], loaded=", ".join(result["loaded"]) or "-"))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+Offline benchmark of Lnhog_change.
+
+Eden-NET and OSS are replaced by local stand-ins: script_data, target cells with GSM neighbors,
+EMSHandler.get_child_attributes, push_ems_attributes_by_oss and getEMSAttributes.
+Every EMS call sleeps for a configurable latency, so the effect of chunking and concurrency is visible.
+
+ScriptMain is run end to end, and every phase (read, plan, push, verify, report) is timed separately.
+
+Usage:
+    python benchmarks/bench_lnhog_change.py --cells 1000,10000,200000 --latency-ms 20
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StandInConfigManager(object):
+    """ConfigManager stand-in: ini settings and module parameters come from script_data"""
+
+    def __init__(self, script_data):
+        self.script_data = script_data
+        self.module_parameters = script_data.GetParameters()
+
+    def get_int(self, name, default=None):
+        return int(self.script_data.ini.get(name, default))
+
+    def get_str(self, name, default=None):
+        return self.script_data.ini.get(name, default)
+
+    def get_bool(self, name, default=None):
+        value = self.script_data.ini.get(name, default)
+        return value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes")
+
+
+class StandInExcelWrapper(object):
+    """ExcelWrapper stand-in on top of a regular openpyxl workbook"""
+
+    def __init__(self, outputfile):
+        import openpyxl
+        self.outputfile = outputfile
+        self.workbook = openpyxl.Workbook()
+        self.workbook.remove(self.workbook.active)
+        self.sheet = None
+
+    def AddWorksheets(self, names):
+        for name in names:
+            self.workbook.create_sheet(name)
+
+    def UseSheet(self, name):
+        self.sheet = self.workbook[name]
+
+    def AddHeaders(self, header, color=None, bold=False):
+        self.sheet.append(header)
+
+    def AddData(self, rows):
+        for row in rows:
+            self.sheet.append([v if v is None or isinstance(v, (str, int, float)) else str(v) for v in row])
+
+    def SaveWorkbook(self):
+        self.workbook.save(self.outputfile)
+
+
+def install_stand_ins():
+    """Registers stand-in enetsdk/enetconfig/tiermap modules, the real ones need a live Eden-NET"""
+    enetsdk = types.ModuleType("enetsdk")
+    enetsdk.ENET_PARAM_TYPE_STRING = "string"
+    enetsdk.ENET_PARAM_TYPE_STRING_SET = "string_set"
+    enetsdk.ScriptParametersFromTuples = lambda tuples: list(tuples)
+    framework = types.ModuleType("enetsdk.Framework")
+    cm_handler = types.ModuleType("enetsdk.Framework.cm_handler")
+    cm_handler.EMSHandler = FakeEms
+    utility = types.ModuleType("enetsdk.Utility")
+    utility.ExcelWrapper = StandInExcelWrapper
+    enetconfig = types.ModuleType("enetconfig")
+    enetconfig_config = types.ModuleType("enetconfig.config")
+    enetconfig_config.ConfigManager = StandInConfigManager
+    tiermap = types.ModuleType("tiermap")
+    tier_mapper = types.ModuleType("tiermap.tier_mapper")
+    tier_mapper.TierMapper = object
+    exceptions = types.ModuleType("tiermap.exceptions")
+    sys.modules.update({
+        "enetsdk": enetsdk, "enetsdk.Framework": framework, "enetsdk.Framework.cm_handler": cm_handler,
+        "enetsdk.Utility": utility, "enetconfig": enetconfig, "enetconfig.config": enetconfig_config,
+        "tiermap": tiermap, "tiermap.tier_mapper": tier_mapper, "tiermap.exceptions": exceptions,
+    })
+
+
+class GsmCell(object):
+    technology = "GSM"
+
+    def __init__(self, dn, bcch_frequency):
+        self.dn = dn
+        self.bcch_frequency = bcch_frequency
+
+
+class LteCell(object):
+
+    def __init__(self, dn, neighbors):
+        self.dn = dn
+        self.neighbors = neighbors
+
+    def GetNeighbors(self, neighborType=None, ignore_missing_data=False):
+        Calls.call("GetNeighbors", 1, Calls.neighbor_latency)
+        return self.neighbors
+
+
+class Network(object):
+    """
+    Synthetic topology: three LTE cells per MRBTS, GSM neighbors from a shared pool,
+    LNHOG objects that are missing, drifted or extra in the given shares of cells
+    """
+
+    def __init__(self, cells, neighbors, missing, drift, extra, seed=1):
+        rnd = random.Random(seed)
+        gsm = [GsmCell("PLMN-PLMN/BSC-%d/BCF-%d/BTS-%d" % (i // 1000, i, i), rnd.randint(0, 1023))
+               for i in range(max(neighbors, cells // 3))]
+        self.cells = []
+        self.objects = {}
+        for i in range(cells):
+            dn_cell = "PLMN-PLMN/MRBTS-%d/LNBTS-%d/LNCEL-%d" % (i // 3, i // 3, i % 3)
+            cell_neighbors = rnd.sample(gsm, rnd.randint(neighbors // 2, neighbors))
+            self.cells.append(LteCell(dn_cell, cell_neighbors))
+            earfcn, band = rnd.choice([("1300", "LTE_1800"), ("6200", "LTE_800"), ("3000", "LTE_2600")])
+            bandwidth = rnd.choice(["10", "20"])
+            self.objects[dn_cell + "/LNCEL_FDD-0"] = {"earfcnDL": earfcn, "dlChBw": bandwidth + " MHz"}
+            band_bandwidth = band + "_" + bandwidth
+            r = rnd.random()
+            if r >= missing:
+                lnhog = dict(TEMPLATE_PARAMS,
+                             b2Threshold1GERAN=str(B2_THRESHOLD1_GERAN.get(band_bandwidth, -120)),
+                             b2Threshold1GERANQci1=str(B2_THRESHOLD1_GERAN_QCI1.get(band_bandwidth, -120)),
+                             arfcnValueListGERAN=sorted({str(n.bcch_frequency) for n in cell_neighbors}))
+                if r < missing + drift:
+                    lnhog["arfcnValueListGERAN"] = lnhog["arfcnValueListGERAN"][1:]
+                    lnhog["nccperm"] = "1"
+                self.objects[dn_cell + "/LNHOG-0"] = lnhog
+            if rnd.random() < extra:
+                self.objects[dn_cell + "/LNHOG-1"] = dict(TEMPLATE_PARAMS)
+        self.children = {}
+        for dn in self.objects:
+            self.add_child(dn)
+
+    def add_child(self, dn):
+        parent, child = dn.rsplit("/", 1)
+        self.children.setdefault(parent, []).append((child.split("-", 1)[0], dn))
+
+    def remove_child(self, dn):
+        parent, child = dn.rsplit("/", 1)
+        self.children[parent].remove((child.split("-", 1)[0], dn))
+
+
+TEMPLATE_PARAMS = {"bandIndicatorGERAN": "dcs1800", "reportIntervalGERAN": "sec1", "nccperm": "255",
+                   "hysB2ThresholdGERAN": "0", "b2Threshold2RssiGERAN": "-110", "b2TimeToTriggerGERANMeas": "ms256",
+                   "b2Threshold2RssiGERANQci1": "-110"}
+B2_THRESHOLD1_GERAN = {"LTE_1800_20": -110, "LTE_800_10": -112}
+B2_THRESHOLD1_GERAN_QCI1 = {"LTE_1800_20": -108, "LTE_2600_20": -110}
+
+
+def template_bytes():
+    import openpyxl
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["Parametr", "Value"])
+    for param, value in TEMPLATE_PARAMS.items():
+        ws.append([param, value])
+    ws.append(["b2Threshold1GERAN", json.dumps(B2_THRESHOLD1_GERAN)])
+    ws.append(["b2Threshold1GERANQci1", json.dumps(B2_THRESHOLD1_GERAN_QCI1)])
+    stream = io.BytesIO()
+    wb.save(stream)
+    return stream.getvalue()
+
+
+class Calls(object):
+    """EMS call counters and latency of the stand-ins"""
+    network = None
+    latency = 0.0
+    dn_latency = 0.0
+    neighbor_latency = 0.0
+    activation_latency = 0.0
+    counters = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def call(cls, name, dns, latency=None):
+        with cls.lock:
+            counter = cls.counters.setdefault(name, [0, 0])
+            counter[0] += 1
+            counter[1] += dns
+        latency = cls.latency + cls.dn_latency * dns if latency is None else latency
+        if latency:
+            time.sleep(latency)
+
+
+class FakeEms(object):
+    """EMSHandler stand-in working on Calls.network"""
+
+    def __init__(self, script_data):
+        self.script_data = script_data
+
+    def get_child_attributes(self, list_dn, child_class, attributes, return_by_dn=False):
+        Calls.call("get_child_attributes", len(list_dn))
+        network = Calls.network
+        result = {}
+        for dn in list_dn:
+            for object_class, dn_child in network.children.get(dn, ()):
+                if object_class == child_class:
+                    values = network.objects[dn_child]
+                    result[dn_child] = {a: values[a] for a in attributes[child_class] if a in values}
+        return result
+
+    def push_ems_attributes_by_oss(self, region_name, updates=None, creates=None, deletes=None):
+        dns = list(updates or {}) + list(creates or {}) + list(deletes or [])
+        mrbts = len({dn.split("/LNBTS-")[0] for dn in dns})
+        Calls.call("push_ems_attributes_by_oss", len(dns),
+                   Calls.latency + Calls.dn_latency * len(dns) + Calls.activation_latency * mrbts)
+        Calls.call("MRBTS activations", mrbts, 0)
+        network = Calls.network
+        for dn, params in (creates or {}).items():
+            if dn not in network.objects:
+                network.add_child(dn)
+            network.objects[dn] = {k: v if isinstance(v, list) else str(v) for k, v in params.items()}
+        for dn, params in (updates or {}).items():
+            network.objects.setdefault(dn, {}).update(params)
+        for dn in deletes or []:
+            if network.objects.pop(dn, None) is not None:
+                network.remove_child(dn)
+        return "OK"
+
+
+class FakeEmsService(object):
+    """GetEmsService() stand-in"""
+
+    def getEMSAttributes(self, data_preparation):
+        Calls.call("getEMSAttributes", len(data_preparation))
+        objects = Calls.network.objects
+        return {dn: {p: objects[dn].get(p) for p in params} for dn, params in data_preparation.items() if dn in objects}
+
+
+class FakeScriptData(object):
+
+    def __init__(self, network, outdir, template, ini, mode):
+        self.network = network
+        self.outdir = outdir
+        self.template = template
+        self.ini = ini
+        self.parameters = {"SON Operation Mode": mode, "Email Addresses (Optional)": "", "Report prefix": "bench",
+                           "Audit Type": "All cells"}
+
+    def GetTargets(self):
+        return self.network.cells
+
+    def GetParameters(self):
+        return self.parameters
+
+    def GetRegionName(self):
+        return "BENCH"
+
+    def GetModuleName(self):
+        return "Lnhog_change"
+
+    def GetConfig(self, name):
+        return {"file_name": "bench_template.xlsx", "raw config file": io.BytesIO(self.template)}
+
+    def GetUserOutputFilesLoc(self):
+        return self.outdir + os.sep
+
+    def GetEmsService(self):
+        return FakeEmsService()
+
+    def get_emailer(self):
+        return None
+
+
+def timed(timings, name, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[name] = time.perf_counter() - start
+    return result
+
+
+def run_phases(module, script_data, ini):
+    """Runs the phases of ScriptMain one by one, returns {phase: seconds}"""
+    timings = {}
+    template = module.TemplateLoader().load(io.BytesIO(script_data.template), "bench_template.xlsx")
+    default_param = dict(template.params)
+    ems_client = FakeEms(script_data)
+    amount_in_request = int(ini.get("amount_in_request", 300))
+    read_workers = int(ini.get("read_workers", 4))
+
+    def read():
+        topology = module.TopologyIndex.load(script_data.GetTargets(), amount_in_request,
+                                             int(ini.get("topology_workers", 4)))
+        list_dn_cell, dict_bcch = module.LnhogPlanner.collect_bcch(topology)
+        reader = module.EmsReader(ems_client, amount_in_request, read_workers)
+        dict_ems = reader.get_child_attributes(list_dn_cell, dict(module.CARRIER_ATTRIBUTES, LNHOG=module.LNHOG_ATTRIBUTES))
+        return list_dn_cell, dict_bcch, dict_ems
+
+    list_dn_cell, dict_bcch, dict_ems = timed(timings, "read", read)
+
+    def plan():
+        planner = module.LnhogPlanner(default_param, module.BandResolver(
+            default_param, band_table=module.BandTable(template.extra_bands)))
+        cell_states = module.CellState.build(list_dn_cell, dict_bcch, dict_ems)
+        create, update, delete = planner.plan(cell_states)
+        return create, update, delete, module.CellState.current_values(cell_states, list(create) + list(update) + list(delete))
+
+    create, update, delete, current_values = timed(timings, "plan", plan)
+    push_result = timed(timings, "push", module.pusher, ems_client, "BENCH", create, update, delete,
+                        int(ini.get("push_batch_size", 100)), int(ini.get("push_workers", 2)),
+                        int(ini.get("push_retries", 1)))
+
+    def verify():
+        read_set_date = module.ReadSetData(script_data, amount_in_request, read_workers)
+        checks = {}
+        for name, changes in (("Create", create), ("Update", update)):
+            real_val, etalon, _ = read_set_date.read_for_check(changes, push_result, current_values)
+            checks[name] = list(module.CheckingChanges().iter_check_create_and_update(real_val, etalon))
+        return checks
+
+    checks = timed(timings, "verify", verify)
+
+    def report():
+        outputfile = os.path.join(script_data.outdir, "phases.xlsx")
+        if ini.get("report_format", "xlsx") in module.StreamingReportGenerator.FORMATS:
+            rep = module.StreamingReportGenerator(outputfile, "", "", ini["report_format"])
+        else:
+            rep = module.ReportGenerator(outputfile, "", "")
+        for name in ("Create", "Update", "Delete"):
+            sheet = rep.create_new_sheets(name, ["Object", "Parameter", "Value", "Result"])
+        for name, results in checks.items():
+            sheet.UseSheet(name)
+            sheet.AddData(rep.check_rows(results))
+        rep.saved_file()
+
+    timed(timings, "report", report)
+    timings["changes"] = len(create) + len(update) + len(delete)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cells", default="1000,10000", help="comma separated numbers of LTE cells")
+    parser.add_argument("--neighbors", type=int, default=40, help="maximum GSM neighbors per LTE cell")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="latency of every EMS call")
+    parser.add_argument("--dn-latency-us", type=float, default=20.0, help="additional latency per dn in an EMS call")
+    parser.add_argument("--neighbor-latency-ms", type=float, default=0.0, help="latency of GetNeighbors of one cell")
+    parser.add_argument("--activation-latency-ms", type=float, default=0.0,
+                        help="additional push latency per MRBTS in the push")
+    parser.add_argument("--missing", type=float, default=0.02, help="share of cells without LNHOG")
+    parser.add_argument("--drift", type=float, default=0.02, help="share of cells with wrong LNHOG parameters")
+    parser.add_argument("--extra", type=float, default=0.01, help="share of cells with an additional LNHOG")
+    parser.add_argument("--mode", default="Closed Loop", choices=["Closed Loop", "Open Loop"])
+    parser.add_argument("--ini", default="{}", help="ini settings as json, e.g. '{\"report_format\": \"xlsx_stream\"}'")
+    parser.add_argument("--skip-e2e", action="store_true", help="only run the phases separately")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="trace the Python heap of the end to end run (slower), e.g. to check CELL_MEMORY_KB")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    install_stand_ins()
+    sys.path.insert(0, ROOT)
+    import Lnhog_change as module
+
+    ini = dict({"Max_num_changes_to_push": 10 ** 9}, **json.loads(args.ini))
+    template = template_bytes()
+    Calls.latency = args.latency_ms / 1000.0
+    Calls.dn_latency = args.dn_latency_us / 1000000.0
+    Calls.neighbor_latency = args.neighbor_latency_ms / 1000.0
+    Calls.activation_latency = args.activation_latency_ms / 1000.0
+    results = []
+    print("{:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>8} {:>11}".format(
+        "cells", "read", "plan", "push", "verify", "report", "e2e", "changes", "calls", "activations"))
+    for cells in [int(c) for c in args.cells.split(",")]:
+        outdir = tempfile.mkdtemp(prefix="lnhog_bench_")
+        try:
+            result = {"cells": cells}
+            Calls.network = Network(cells, args.neighbors, args.missing, args.drift, args.extra)
+            Calls.counters = {}
+            with redirect_stdout(io.StringIO()):
+                result.update(run_phases(module, FakeScriptData(Calls.network, outdir, template, ini, args.mode), ini))
+            result["calls"] = dict(Calls.counters)
+            if not args.skip_e2e:
+                Calls.network = Network(cells, args.neighbors, args.missing, args.drift, args.extra)
+                Calls.counters = {}
+                if args.trace_memory:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                with redirect_stdout(io.StringIO()):
+                    module.ScriptMain(FakeScriptData(Calls.network, outdir, template, ini, args.mode), None)
+                result["e2e"] = time.perf_counter() - start
+                if args.trace_memory:
+                    result["e2e_heap_peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024.0
+                    tracemalloc.stop()
+                result["e2e_calls"] = dict(Calls.counters)
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+        results.append(result)
+        print("{cells:>8} {read:>8.2f} {plan:>8.2f} {push:>8.2f} {verify:>8.2f} {report:>8.2f} {e2e:>8} {changes:>9} {calls:>8} "
+              "{activations:>11}".format(
+                  e2e="%.2f" % result["e2e"] if "e2e" in result else "-",
+                  calls=sum(c[0] for name, c in result["calls"].items() if name not in ("GetNeighbors", "MRBTS activations")),
+                  activations=result["calls"].get("MRBTS activations", [0, 0])[1],
+                  **{k: v for k, v in result.items() if k not in ("e2e", "calls")}))
+
+    traced = [result for result in results if "e2e_heap_peak_kb" in result]
+    if len(traced) > 1 and traced[-1]["cells"] != traced[0]["cells"]:
+        print("Python heap per cell: {:.2f} KB".format(
+            (traced[-1]["e2e_heap_peak_kb"] - traced[0]["e2e_heap_peak_kb"]) / (traced[-1]["cells"] - traced[0]["cells"])))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()